@@ -1,15 +1,29 @@
 import os
 import time
-import spotipy as sp
 import generate_playlists as gp
 from dotenv import load_dotenv
-from spotipy.oauth2 import SpotifyOAuth
-from flask import Flask, request, url_for, session, redirect, render_template
+from flask import Flask, request, url_for, session, redirect, render_template, jsonify, abort, Response
+from cache import feature_cache, playlist_cache, artist_index_cache, catalog_cache, model_cache
+from catalog import get_catalog
+from instrumentation import metrics
+from jobs import JobLimitError, DONE, FAILED, create_queue
+from prefetch import prefetcher
+from ratelimit import BULK, rate_limiter
+from sessions import create_session_interface
+from spotify_client import create_client, get_oauth
 
 load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY")
+app.session_interface = create_session_interface()
+
+job_queue = create_queue()
+
+# Seconds between checks of a streamed job, and seconds a stream stays open before the browser reconnects,
+# overridable through the environment
+STREAM_INTERVAL = float(os.getenv("LAZIFY_STREAM_INTERVAL", 0.25))
+STREAM_TIMEOUT = float(os.getenv("LAZIFY_STREAM_TIMEOUT", 30))
 
 @app.route("/")
 @app.route("/index")
@@ -89,10 +103,9 @@ def playlists():
     
     if request.method == "GET":
         # Retrieve user info and user"s playlists
-        spotify = sp.Spotify(auth=token_info["access_token"])
-        user = spotify.current_user()
-        display_name = user["display_name"]
-        playlists = spotify.current_user_playlists()["items"]
+        spotify = create_client(token_info["access_token"])
+        display_name = get_user(spotify)["display_name"]
+        playlists = get_catalog(spotify, get_user(spotify)["id"]).playlists
         
         return render_template("playlists.html", display_name=display_name, playlists=playlists)
     
@@ -102,7 +115,9 @@ def playlists():
 def select_option():
     """Render option selection page.
     
-    Render the option selection page. The user's selected playlist(s) is/are stored in the session.
+    Render the option selection page. The user's selected playlist(s) is/are stored in the session, along with
+    their snapshot ids from the playlist listing, so later steps don't need to look them up again. Their tracks
+    and audio features are prefetched in the background while the user picks an option.
     On this page, the user can select which option to modify the playlist(s) with or generate
     new playlists from.
 
@@ -115,7 +130,7 @@ def select_option():
 
     # Make sure user is logged in
     try:
-        get_token()
+        token_info = get_token()
     except:
         return redirect(url_for("login"))
 
@@ -124,7 +139,14 @@ def select_option():
     else:
         # Retrieve ids of selected playlists
         selected_playlists = request.form.get("selected_playlists").split(",")
+        spotify = create_client(token_info["access_token"])
+        user_id = get_user(spotify)["id"]
         session["selected_playlists"] = selected_playlists
+        session["snapshot_ids"] = gp.get_snapshot_ids(spotify, user_id, selected_playlists)
+
+        # Warm the track caches while the user decides, without holding up page loads
+        bulk_spotify = create_client(token_info["access_token"], priority=BULK)
+        prefetcher.start(user_id, bulk_spotify, selected_playlists, session["snapshot_ids"])
         
         return render_template("select_option.html")
 
@@ -149,9 +171,10 @@ def select_artist():
         return redirect(url_for("login"))
     
     if request.method == "POST":
-        spotify = sp.Spotify(auth=token_info["access_token"])
-        user_id = spotify.current_user()["id"]
-        artists = sorted(gp.get_artists(spotify, user_id, session["selected_playlists"]))
+        spotify = create_client(token_info["access_token"])
+        user_id = get_user(spotify)["id"]
+        artists = gp.get_artists(spotify, user_id, session["selected_playlists"], session.get("snapshot_ids"))
+        artists = sorted(artists, key=lambda artist: artist[1].lower())
 
         return render_template("select_artist.html", artists=artists)
     
@@ -161,13 +184,15 @@ def select_artist():
 def result():
     """Render result page.
     
-    Render the result page, which displays the new or modified playlist(s) using Spotify embeds.
+    On POST, queue the playlist generation as a background job and redirect to the result page for that job.
+    The result page shows the job's progress and each new or modified playlist as a Spotify embed as soon as
+    it is ready, streamed from the job's events.
 
     Args:
         None
     
     Returns:
-        A rendered template of result.html
+        A redirect to the result page for the job, or a rendered template of result.html
     """
 
     # Make sure user is logged in
@@ -177,21 +202,160 @@ def result():
         return redirect(url_for("login"))
 
     if request.method == "POST":
-        new_playlist_ids = []
-        spotify = sp.Spotify(auth=token_info["access_token"])
-        user_id = spotify.current_user()["id"]
+        # The client is handed to the background job, so its calls yield to page loads
+        spotify = create_client(token_info["access_token"], priority=BULK)
+        user_id = get_user(spotify)["id"]
 
         # Check for each of the routes
-        if "option" in request.form:
-            option = request.form.get("option")
-            new_playlist_ids = gp.generate(option, spotify, user_id, session["selected_playlists"])
-        elif "selected_artists" in request.form:
-            selected_artists = request.form.get("selected_artists").split(",")
-            new_playlist_ids = gp.artists(spotify, user_id, selected_artists, session["selected_playlists"])
+        try:
+            if "option" in request.form:
+                option = request.form.get("option")
+                settings = {}
+                if option == "cluster" and request.form.get("strategy"):
+                    settings["strategy"] = request.form.get("strategy")
+                job_id = job_queue.submit(user_id, prefetcher.after, user_id, gp.iter_generate, option, spotify, user_id, session["selected_playlists"], **settings)
+            elif "selected_artists" in request.form:
+                selected_artists = request.form.get("selected_artists").split(",")
+                job_id = job_queue.submit(user_id, prefetcher.after, user_id, gp.iter_artists, spotify, user_id, selected_artists, session["selected_playlists"])
+            else:
+                return redirect(url_for("select_option"))
+        except JobLimitError as e:
+            return render_template("result.html", error=str(e)), 429
+
+        # Remember the user's recent jobs so only they can see them
+        session["jobs"] = session.get("jobs", [])[-9:] + [job_id]
+
+        return redirect(url_for("result", job=job_id))
+
+    job = get_job(request.args.get("job"))
+    if job["status"] == FAILED:
+        return render_template("result.html", error="Something went wrong while making your playlists, please try again")
+    if job["status"] != DONE:
+        sources = [embed_source(playlist_id) for playlist_id in job["result"] or []]
+        return render_template("result.html", job_id=job["id"], progress=job["progress"], sources=sources)
+
+    sources = [embed_source(new_playlist_id) for new_playlist_id in job["result"]]
+
+    return render_template("result.html", sources=sources)
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    """Report the status of a background job.
+
+    Used by the result page to poll the progress of the job generating the user's playlists.
+
+    Args:
+        job_id (str): Id for the job
+    
+    Returns:
+        A JSON response with the job's status, progress and, once done, the playlist ids
+    """
+
+    job = get_job(job_id)
+
+    return jsonify(status=job["status"], progress=job["progress"], playlist_ids=job["result"])
+
+@app.route("/jobs/<job_id>/events")
+def job_events(job_id):
+    """Stream the progress and playlists of a background job.
+
+    Used by the result page to show each playlist as soon as the job has written it. Sends a server-sent event
+    for every change in progress and every new playlist after the first "after" ones, then one when the job is
+    done or has failed. Streams are closed after a while and the browser reconnects, resuming after the last
+    playlist it received.
+
+    Args:
+        job_id (str): Id for the job
+    
+    Returns:
+        A text/event-stream response
+    """
+
+    get_job(job_id)
+    try:
+        sent = int(request.headers.get("Last-Event-ID") or request.args.get("after", 0))
+    except ValueError:
+        sent = 0
+
+    def events(sent):
+        deadline = time.monotonic() + STREAM_TIMEOUT
+        progress = None
+        yield "retry: 1000\n\n"
+        while True:
+            job = job_queue.get(job_id)
+            for playlist_id in (job["result"] or [])[sent:]:
+                sent += 1
+                yield f"id: {sent}\nevent: playlist\ndata: {embed_source(playlist_id)}\n\n"
+            if job["status"] in (DONE, FAILED):
+                yield f"event: {job['status']}\ndata: {job['status']}\n\n"
+                return
+            if job["progress"] != progress:
+                progress = job["progress"]
+                yield f"event: progress\ndata: {progress}\n\n"
+            if time.monotonic() >= deadline:
+                return
+            time.sleep(STREAM_INTERVAL)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(events(sent), mimetype="text/event-stream", headers=headers)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Report the server's metrics.
+
+    Exposes API call counts and latencies, retries, payload sizes, stage timings and cache statistics in the
+    Prometheus text format.
+
+    Args:
+        None
+    
+    Returns:
+        A plain text response with the metrics
+    """
 
-        sources = [f"https://open.spotify.com/embed/playlist/{new_playlist_id}?utm_source=generator&theme=0" for new_playlist_id in new_playlist_ids]
+    caches = {
+        "audio_features": feature_cache,
+        "playlist_tracks": playlist_cache,
+        "artist_index": artist_index_cache,
+        "playlist_catalog": catalog_cache,
+        "models": model_cache
+    }
+    for name, cache in caches.items():
+        for stat, value in cache.stats().items():
+            metrics.set(f"lazify_cache_{stat}", {"cache": name}, value)
+    metrics.set("lazify_rate_limit_rate", value=rate_limiter.current_rate())
 
-        return render_template("result.html", sources=sources)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+def get_job(job_id):
+    """Get one of the user's background jobs.
+
+    Aborts with 404 if the job doesn't exist or wasn't started by the user in this session.
+
+    Args:
+        job_id (str): Id for the job
+    
+    Returns:
+        dict: The job's record
+    """
+
+    job = job_queue.get(job_id) if job_id in session.get("jobs", []) else None
+    if job is None:
+        abort(404)
+
+    return job
+
+def embed_source(playlist_id):
+    """Get the URL of the Spotify embed for a playlist.
+
+    Args:
+        playlist_id (str): Id for the playlist
+    
+    Returns:
+        str: URL to show the playlist in an iframe
+    """
+
+    return f"https://open.spotify.com/embed/playlist/{playlist_id}?utm_source=generator&theme=0"
 
 def get_token():
     """Get the user's access token.
@@ -216,13 +380,36 @@ def get_token():
     if is_expired:
         sp_oauth = create_spotify_oauth()
         token_info = sp_oauth.refresh_access_token(token_info["refresh_token"])
+        session["token_info"] = token_info
     
     return token_info
 
+def get_user(spotify):
+    """Get the user's id and display name.
+
+    The user is only looked up the first time and then kept in the session, so routes don't need an extra
+    call to the Spotify API to find out who is logged in.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object for the user
+    
+    Returns:
+        dict: The user's id and display name
+    """
+
+    user = session.get("user")
+    if user is None:
+        current_user = spotify.current_user()
+        user = {"id": current_user["id"], "display_name": current_user["display_name"]}
+        session["user"] = user
+
+    return user
+
 def create_spotify_oauth():
     """Create a Spotify OAuth object.
 
-    Create a Spotify OAuth object using the client ID and client secret.
+    Create a Spotify OAuth object using the client ID and client secret. The object is created once per
+    redirect URI and reused afterwards, and its token requests go through the shared HTTP session.
 
     Args:
         None
@@ -238,5 +425,5 @@ def create_spotify_oauth():
         redirect_uri = url_for("callback", _external=True)
     scope = os.getenv("SCOPE")
 
-    sp_oauth = SpotifyOAuth(client_id, client_secret, redirect_uri, scope=scope)
+    sp_oauth = get_oauth(client_id, client_secret, redirect_uri, scope)
     return sp_oauth
\ No newline at end of file
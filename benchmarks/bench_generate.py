@@ -0,0 +1,226 @@
+"""Benchmarks every playlist generation option against a fake Spotify API.
+
+Each option runs in a fresh process on synthetic playlists, with the on-disk track store and caches disabled
+(LAZIFY_TRACK_STORE and LAZIFY_CACHE_PATH set to empty strings), so caches start cold on every run and peak
+memory isn't shared between runs. Wall time, CPU time, peak RSS, API calls and the time spent in each stage are reported, and the
+results can be saved as JSON tagged with the git commit and compared against an earlier run.
+
+By default the options run against an in-process FakeSpotify. With --server they run against a local HTTP
+server through a real spotipy client instead, which also measures HTTP and JSON overhead.
+
+Usage:
+    python benchmarks/bench_generate.py [--sizes 100,1000,10000] [--options cluster,merge] [--server]
+        [--latency 0.02] [--rate-limit-every 50] [--output results.json] [--compare baseline.json]
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_spotify import FakeSpotify
+
+OPTIONS = ["cluster", "recommend", "artists", "merge", "remove_duplicates"]
+SIZES = [100, 1000, 10000]
+
+def run(option, size, settings):
+    """Runs one option on synthetic playlists and measures it.
+
+    Args:
+        option (str): Option to run, one of OPTIONS
+        size (int): Total number of tracks across the selected playlists
+        settings (dict): Benchmark settings, see parse_args
+
+    Returns:
+        dict: Measurements for the run
+    """
+
+    import generate_playlists as gp
+    from fake_server import FakeSpotifyServer
+    from instrumentation import profile_job
+    from spotify_client import create_client
+
+    fake = FakeSpotify(
+        latency=settings["latency"],
+        rate_limit_every=settings["rate_limit_every"],
+        retry_after=settings["retry_after"]
+    )
+    n_playlists = settings["playlists"]
+    playlists = [
+        fake.add_playlist(size // n_playlists, duplicates=size // n_playlists // 20) for _ in range(n_playlists)
+    ]
+
+    server = None
+    spotify = fake
+    if settings["server"]:
+        server = FakeSpotifyServer(fake).start()
+        spotify = create_client("benchmark")
+        spotify.prefix = server.prefix
+
+    start = time.perf_counter()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        with profile_job(f"bench-{option}-{size}", spotify) as profile:
+            if option == "artists":
+                artist_ids = [f"artist{i:06d}" for i in range(3)]
+                result = gp.artists(spotify, "user", artist_ids, playlists)
+            else:
+                result = gp.generate(option, spotify, "user", playlists)
+        elapsed = time.perf_counter() - start
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        if server is not None:
+            server.stop()
+
+    calls = dict(fake.calls)
+    rate_limited = calls.pop("429", 0)
+
+    return {
+        "option": option,
+        "tracks": size,
+        "playlists": n_playlists,
+        "wall_seconds": elapsed,
+        "cpu_seconds": (end_usage.ru_utime - usage.ru_utime) + (end_usage.ru_stime - usage.ru_stime),
+        "peak_rss_mb": _peak_rss_mb(end_usage),
+        "api_calls": sum(calls.values()),
+        "rate_limited": rate_limited,
+        "calls": calls,
+        "stages": {name: stats["seconds"] for name, stats in profile.summary()["stages"].items()},
+        "results": len(result)
+    }
+
+def benchmark(settings):
+    """Runs every selected option at every size, each in a fresh process.
+
+    Args:
+        settings (dict): Benchmark settings, see parse_args
+
+    Returns:
+        dict: The git commit, environment, settings and one measurement per run
+    """
+
+    results = []
+    for size in settings["sizes"]:
+        for option in settings["options"]:
+            command = [sys.executable, os.path.abspath(__file__), "--run", option, str(size), "--settings", json.dumps(settings)]
+            process = subprocess.run(command, env=_env(), capture_output=True, text=True)
+            if process.returncode != 0:
+                print(process.stderr, file=sys.stderr)
+                results.append({"option": option, "tracks": size, "error": process.stderr.strip().splitlines()[-1]})
+                continue
+            results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+            print_result(results[-1])
+
+    return {
+        "commit": _git("rev-parse", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": settings,
+        "results": results
+    }
+
+def print_result(result, baseline=None):
+    """Prints one run's measurements as a table row.
+
+    Args:
+        result (dict): Measurements for the run
+        baseline (dict): Measurements for the same option and size from an earlier run, to print the change
+
+    Returns:
+        None
+    """
+
+    row = (
+        f"{result['option']:<18}{result['tracks']:>8}{result['wall_seconds']:>10.2f} s{result['cpu_seconds']:>9.2f} s"
+        f"{result['peak_rss_mb']:>9.0f} MB{result['api_calls']:>8} calls{result['rate_limited']:>6} 429s"
+    )
+    if baseline is not None and "wall_seconds" in baseline:
+        change = result["wall_seconds"] / baseline["wall_seconds"] - 1 if baseline["wall_seconds"] else 0.0
+        row += f"{change:>+9.1%} wall, {result['api_calls'] - baseline['api_calls']:+d} calls"
+    print(row)
+
+def compare(report, baseline):
+    """Prints a report's measurements next to those of an earlier report.
+
+    Args:
+        report (dict): Benchmark report
+        baseline (dict): Benchmark report to compare against
+
+    Returns:
+        None
+    """
+
+    print(f"\nCompared to {baseline['commit'][:10]}:")
+    previous = {(result["option"], result["tracks"]): result for result in baseline["results"]}
+    for result in report["results"]:
+        if "error" not in result:
+            print_result(result, previous.get((result["option"], result["tracks"])))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark Lazify's playlist generation options offline.")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="Comma-separated total track counts")
+    parser.add_argument("--options", default=",".join(OPTIONS), help="Comma-separated options to run")
+    parser.add_argument("--playlists", type=int, default=3, help="Number of selected playlists")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds each API call takes")
+    parser.add_argument("--rate-limit-every", type=int, default=50, help="Respond with 429 to every nth call")
+    parser.add_argument("--retry-after", type=float, default=0.1, help="Retry-After sent with 429 responses")
+    parser.add_argument("--server", action="store_true", help="Use a local HTTP server and a real spotipy client")
+    parser.add_argument("--output", help="Path to save the results to as JSON")
+    parser.add_argument("--compare", help="Path to earlier JSON results to compare against")
+    parser.add_argument("--run", nargs=2, metavar=("OPTION", "SIZE"), help=argparse.SUPPRESS)
+    parser.add_argument("--settings", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.run:
+        option, size = args.run
+        print(json.dumps(run(option, int(size), json.loads(args.settings))))
+        return
+
+    settings = {
+        "sizes": [int(size) for size in args.sizes.split(",")],
+        "options": args.options.split(","),
+        "playlists": args.playlists,
+        "latency": args.latency,
+        "rate_limit_every": args.rate_limit_every,
+        "retry_after": args.retry_after,
+        "server": args.server
+    }
+
+    print(f"{'option':<18}{'tracks':>8}{'wall':>12}{'cpu':>11}{'peak rss':>12}")
+    report = benchmark(settings)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+def _peak_rss_mb(usage):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return usage.ru_maxrss / scale
+
+def _env():
+    # Keep every run away from the on-disk track store and caches, so results don't depend on earlier runs
+    return {**os.environ, "LAZIFY_TRACK_STORE": "", "LAZIFY_CACHE_PATH": ""}
+
+def _git(*args):
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.run(["git", *args], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Compares serial and concurrent playlist paging against a fake Spotify API.
+
+Usage:
+    python benchmarks/bench_paging.py [n_tracks] [latency]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_spotify import FakeSpotify
+from fetch import call_with_retry, fetch_pages
+
+def serial(spotify, playlist):
+    results = call_with_retry(spotify.user_playlist_tracks, "user", playlist)
+    tracks = results["items"]
+    while results["next"]:
+        results = call_with_retry(spotify.next, results)
+        tracks.extend(results["items"])
+    return [track["track"]["uri"] for track in tracks]
+
+def concurrent(spotify, playlist):
+    items = fetch_pages(lambda offset: spotify.user_playlist_tracks("user", playlist, limit=100, offset=offset), 100)
+    return [track["track"]["uri"] for track in items]
+
+def main():
+    n_tracks = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+
+    spotify = FakeSpotify(latency=latency, rate_limit_every=37)
+    playlist = spotify.add_playlist(n_tracks)
+
+    timings = {}
+    for name, function in [("serial", serial), ("concurrent", concurrent)]:
+        start = time.perf_counter()
+        uris = function(spotify, playlist)
+        timings[name] = time.perf_counter() - start
+        assert uris == spotify.playlists[playlist]["uris"], f"{name} returned tracks out of order"
+
+    print(f"{n_tracks} tracks, {latency * 1000:.0f} ms per call")
+    for name, elapsed in timings.items():
+        print(f"  {name:<12}{elapsed:8.2f} s")
+    print(f"  speedup     {timings['serial'] / timings['concurrent']:8.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""Benchmarks the web process's startup time and memory.
+
+Measures how long importing the app takes in a fresh process, which is what every gunicorn worker pays when it
+boots, and how much memory it holds afterwards. With --gunicorn it also starts gunicorn with several workers and
+reports the time until it serves the home page and each worker's memory, split into what it shares with the
+master and what is its own.
+
+Each mode is run in turn:
+
+    eager: the whole numeric stack is imported at startup (LAZIFY_LAZY_IMPORTS=0, the previous behaviour)
+    lazy: the numeric stack is imported on first use
+    preload: lazy imports, with the numeric stack imported in the gunicorn master (LAZIFY_PRELOAD=1)
+
+Usage:
+    python benchmarks/bench_startup.py [--modes eager,lazy,preload] [--repeat 5] [--gunicorn] [--workers 4]
+        [--output results.json] [--compare baseline.json]
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import argparse
+import subprocess
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = {
+    "eager": {"LAZIFY_LAZY_IMPORTS": "0", "LAZIFY_PRELOAD": "0"},
+    "lazy": {"LAZIFY_LAZY_IMPORTS": "1", "LAZIFY_PRELOAD": "0"},
+    "preload": {"LAZIFY_LAZY_IMPORTS": "1", "LAZIFY_PRELOAD": "1"}
+}
+
+# Imports the app in a fresh process and prints how long it took, the resulting peak RSS and the heavy
+# modules it loaded
+IMPORT_SCRIPT = """
+import sys, json, time, resource
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+usage = resource.getrusage(resource.RUSAGE_SELF)
+scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+heavy = [name for name in ("numpy", "pandas", "scipy", "sklearn", "joblib") if name in sys.modules]
+print(json.dumps({"seconds": elapsed, "rss_mb": usage.ru_maxrss / scale, "heavy_modules": heavy}))
+"""
+
+def measure_import(mode, repeat):
+    """Measures importing the app in fresh processes.
+
+    Args:
+        mode (str): Mode to run, one of MODES
+        repeat (int): Number of processes to average over
+
+    Returns:
+        dict: Mean import time, mean peak RSS and the heavy modules loaded
+    """
+
+    runs = []
+    for _ in range(repeat):
+        process = subprocess.run(
+            [sys.executable, "-c", IMPORT_SCRIPT], cwd=ROOT, env=_env(mode), capture_output=True, text=True, check=True
+        )
+        runs.append(json.loads(process.stdout.strip().splitlines()[-1]))
+
+    return {
+        "import_seconds": sum(run["seconds"] for run in runs) / len(runs),
+        "import_rss_mb": sum(run["rss_mb"] for run in runs) / len(runs),
+        "heavy_modules": runs[-1]["heavy_modules"]
+    }
+
+def measure_gunicorn(mode, workers, timeout=60):
+    """Starts gunicorn and measures its startup and its workers' memory.
+
+    Args:
+        mode (str): Mode to run, one of MODES
+        workers (int): Number of gunicorn workers
+        timeout (float): Seconds to wait for gunicorn to serve the home page
+
+    Returns:
+        dict: Seconds until the home page was served, and the mean RSS, PSS and private memory of the workers
+    """
+
+    port = _free_port()
+    command = [
+        sys.executable, "-m", "gunicorn", "app:app", "--config", os.path.join(ROOT, "gunicorn.conf.py"),
+        "--bind", f"127.0.0.1:{port}", "--workers", str(workers)
+    ]
+    start = time.perf_counter()
+    master = subprocess.Popen(command, cwd=ROOT, env=_env(mode), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        ready = _wait_until_serving(f"http://127.0.0.1:{port}/", start + timeout)
+        ready_seconds = time.perf_counter() - start
+
+        # Give every worker time to boot before reading their memory
+        pids = []
+        while time.perf_counter() < start + timeout:
+            pids = _children(master.pid)
+            if len(pids) >= workers:
+                break
+            time.sleep(0.1)
+        time.sleep(1)
+
+        memory = [_memory_mb(pid) for pid in _children(master.pid)]
+        memory = [usage for usage in memory if usage]
+    finally:
+        master.terminate()
+        master.wait()
+
+    result = {"ready_seconds": ready_seconds if ready else None, "workers": len(memory)}
+    for key in ("rss_mb", "pss_mb", "private_mb"):
+        result[f"worker_{key}"] = sum(usage[key] for usage in memory) / len(memory) if memory else None
+    return result
+
+def benchmark(settings):
+    """Runs every selected mode.
+
+    Args:
+        settings (dict): Benchmark settings, see parse_args
+
+    Returns:
+        dict: The git commit, environment, settings and one measurement per mode
+    """
+
+    results = []
+    for mode in settings["modes"]:
+        result = {"mode": mode, **measure_import(mode, settings["repeat"])}
+        if settings["gunicorn"]:
+            result.update(measure_gunicorn(mode, settings["workers"]))
+        results.append(result)
+        print_result(result)
+
+    return {
+        "commit": _git("rev-parse", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": settings,
+        "results": results
+    }
+
+def print_result(result, baseline=None):
+    """Prints one mode's measurements as a table row.
+
+    Args:
+        result (dict): Measurements for the mode
+        baseline (dict): Measurements for the same mode from an earlier run, to print the change
+
+    Returns:
+        None
+    """
+
+    row = f"{result['mode']:<10}{result['import_seconds']:>10.2f} s{result['import_rss_mb']:>9.0f} MB"
+    if "ready_seconds" in result:
+        row += "".join(
+            f"{value:>9.1f}" + unit if value is not None else f"{'-':>9}" + unit
+            for value, unit in [
+                (result["ready_seconds"], " s "),
+                (result["worker_rss_mb"], " MB"),
+                (result["worker_pss_mb"], " MB"),
+                (result["worker_private_mb"], " MB")
+            ]
+        )
+    if baseline is not None:
+        change = result["import_seconds"] / baseline["import_seconds"] - 1 if baseline["import_seconds"] else 0.0
+        row += f"{change:>+9.1%} import"
+    print(row)
+
+def compare(report, baseline):
+    """Prints a report's measurements next to those of an earlier report.
+
+    Args:
+        report (dict): Benchmark report
+        baseline (dict): Benchmark report to compare against
+
+    Returns:
+        None
+    """
+
+    print(f"\nCompared to {baseline['commit'][:10]}:")
+    previous = {result["mode"]: result for result in baseline["results"]}
+    for result in report["results"]:
+        print_result(result, previous.get(result["mode"]))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark Lazify's web process startup.")
+    parser.add_argument("--modes", default=",".join(MODES), help="Comma-separated modes to run")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of fresh imports to average over")
+    parser.add_argument("--gunicorn", action="store_true", help="Also start gunicorn and measure its workers")
+    parser.add_argument("--workers", type=int, default=4, help="Number of gunicorn workers")
+    parser.add_argument("--output", help="Path to save the results to as JSON")
+    parser.add_argument("--compare", help="Path to earlier JSON results to compare against")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    settings = {
+        "modes": args.modes.split(","),
+        "repeat": args.repeat,
+        "gunicorn": args.gunicorn,
+        "workers": args.workers
+    }
+
+    header = f"{'mode':<10}{'import':>12}{'rss':>12}"
+    if args.gunicorn:
+        header += f"{'ready':>12}{'worker rss':>12}{'pss':>12}{'private':>12}"
+    print(header)
+    report = benchmark(settings)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+def _env(mode):
+    # Keep the benchmark away from any on-disk caches and stores, so imports don't create or open databases
+    env = {
+        **os.environ,
+        **MODES[mode],
+        "LAZIFY_TRACK_STORE": "",
+        "LAZIFY_JOB_STORE": "",
+        "LAZIFY_SESSION_STORE": "memory"
+    }
+    env.pop("LAZIFY_CACHE_PATH", None)
+    return env
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _wait_until_serving(url, deadline):
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.02)
+    return False
+
+def _children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+def _memory_mb(pid):
+    # Linux only: PSS splits shared pages between the processes sharing them, private pages are the worker's own
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line and not line.startswith(" "))
+    except OSError:
+        return None
+
+    kb = lambda name: int(fields.get(name, "0 kB").split()[0])
+    return {
+        "rss_mb": kb("Rss") / 1024,
+        "pss_mb": kb("Pss") / 1024,
+        "private_mb": (kb("Private_Clean") + kb("Private_Dirty")) / 1024
+    }
+
+def _git(*args):
+    try:
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import json
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+from spotipy.exceptions import SpotifyException
+
+class FakeSpotifyServer:
+    """Local HTTP server exposing a FakeSpotify as the Spotify Web API.
+
+    Serves the endpoints used by Lazify, with next links and error responses shaped like the real API, so a
+    real spotipy.Spotify client can be benchmarked end to end, including its HTTP session, retries and JSON
+    parsing. Point a client at the server by setting its prefix to the server's prefix.
+
+    Args:
+        fake (FakeSpotify): Fake API providing the playlists, latency and 429s
+    """
+
+    def __init__(self, fake):
+        self.fake = fake
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(fake))
+        self._server.daemon_threads = True
+        self.prefix = f"http://127.0.0.1:{self._server.server_port}/v1/"
+        self._thread = None
+
+    def start(self):
+        """Starts serving in a background thread.
+
+        Returns:
+            FakeSpotifyServer: The same server
+        """
+
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving and closes the socket.
+
+        Returns:
+            None
+        """
+
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+def _handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            self._dispatch("GET")
+
+        def do_POST(self):
+            self._dispatch("POST")
+
+        def do_PUT(self):
+            self._dispatch("PUT")
+
+        def do_DELETE(self):
+            self._dispatch("DELETE")
+
+        def log_message(self, *args):
+            pass
+
+        def _dispatch(self, method):
+            url = urlsplit(self.path)
+            path = url.path.split("/v1/", 1)[-1].strip("/").split("/")
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            length = int(self.headers.get("Content-Length") or 0)
+            payload = json.loads(self.rfile.read(length)) if length else {}
+
+            try:
+                body = _route(fake, method, path, params, payload)
+            except SpotifyException as e:
+                headers = dict(e.headers or {})
+                if "Retry-After" in headers:
+                    # The real API sends whole seconds, and urllib3 ignores anything else
+                    headers["Retry-After"] = str(math.ceil(float(headers["Retry-After"])))
+                self._respond(e.http_status, {"error": {"status": e.http_status, "message": e.msg}}, headers)
+                return
+            except (KeyError, IndexError):
+                self._respond(404, {"error": {"status": 404, "message": "Not found"}})
+                return
+
+            if isinstance(body, dict) and isinstance(body.get("next"), tuple):
+                _, limit, offset = body["next"]
+                body["next"] = self._url(url, dict(params, limit=limit, offset=offset))
+            self._respond(201 if method == "POST" else 200, body)
+
+        def _url(self, url, params):
+            return f"http://{self.headers['Host']}{url.path}?{urlencode(params)}"
+
+        def _respond(self, status, body, headers=None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+def _route(fake, method, path, params, payload):
+    limit = int(params.get("limit", 100))
+    offset = int(params.get("offset", 0))
+
+    # Older spotipy methods still use the users/{user}/playlists/{id} form of the playlist endpoints
+    if path[0] == "users" and len(path) > 3 and path[2] == "playlists":
+        path = path[2:]
+
+    if path == ["me"]:
+        return fake.current_user()
+    if path == ["me", "playlists"]:
+        return fake.current_user_playlists(limit=limit, offset=offset)
+    if path == ["audio-features"]:
+        uris = [f"spotify:track:{track_id}" for track_id in params["ids"].split(",")]
+        return {"audio_features": fake.audio_features(uris)}
+    if path == ["recommendations"]:
+        return fake.recommendations(limit=limit)
+    if path[0] == "users" and path[2:] == ["playlists"] and method == "POST":
+        return fake.user_playlist_create(path[1], payload["name"], public=payload.get("public", True))
+    if path[0] == "playlists" and len(path) == 2:
+        return fake.playlist(path[1])
+    if path[0] == "playlists" and path[2:] == ["tracks"]:
+        if method == "GET":
+            return fake.user_playlist_tracks(None, path[1], limit=limit, offset=offset)
+        if method == "POST":
+            # spotipy sends the uris to add as a bare JSON list
+            uris = payload if isinstance(payload, list) else payload["uris"]
+            return fake.user_playlist_add_tracks(None, path[1], uris)
+        if method == "PUT":
+            return fake.user_playlist_replace_tracks(None, path[1], payload.get("uris", []))
+        if method == "DELETE":
+            return fake.user_playlist_remove_specific_occurrences_of_tracks(
+                None, path[1], payload["tracks"], snapshot_id=payload.get("snapshot_id")
+            )
+
+    raise KeyError(method + " " + "/".join(path))
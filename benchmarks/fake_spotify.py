@@ -0,0 +1,185 @@
+import random
+import threading
+import time
+from collections import Counter
+from spotipy.exceptions import SpotifyException
+
+FEATURES = ["acousticness", "danceability", "energy", "instrumentalness", "liveness", "loudness", "speechiness", "valence"]
+
+class FakeSpotify:
+    """Stand-in for spotipy.Spotify that serves synthetic playlists.
+
+    Implements the subset of the spotipy.Spotify interface used by Lazify, with Web API style pagination,
+    an artificial per-call latency and optional 429 responses, so performance can be measured offline.
+
+    Args:
+        latency (float): Seconds each API call takes
+        rate_limit_every (int): Respond with 429 to every nth call, or 0 to never rate limit
+        retry_after (float): Value of the Retry-After header sent with 429 responses
+        n_artists (int): Number of distinct artists in generated playlists
+        seed (int): Seed for the synthetic data
+    """
+
+    def __init__(self, latency=0.0, rate_limit_every=0, retry_after=0.0, n_artists=200, seed=1738):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.n_artists = n_artists
+        self.calls = Counter()
+        self.playlists = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._n_calls = 0
+        self._n_tracks = 0
+
+    def add_playlist(self, n_tracks, name=None, duplicates=0, owner="user"):
+        """Creates a synthetic playlist.
+
+        Args:
+            n_tracks (int): Number of tracks in the playlist
+            name (str): Name for the playlist
+            duplicates (int): Number of tracks to repeat at the end of the playlist
+            owner (str): Id of the playlist's owner
+
+        Returns:
+            str: Id for the new playlist
+        """
+
+        uris = [self._new_uri() for _ in range(n_tracks)]
+        uris += self._random.sample(uris, min(duplicates, len(uris)))
+        return self._create(name or f"Playlist {len(self.playlists) + 1}", uris, owner)
+
+    # Spotify Web API methods
+
+    def current_user(self):
+        self._call("current_user")
+        return {"id": "user", "display_name": "Benchmark User"}
+
+    def current_user_playlists(self, limit=50, offset=0):
+        self._call("current_user_playlists")
+        playlists = [self._summary(playlist_id) for playlist_id in self.playlists]
+        return self._page(playlists, limit, offset, self.current_user_playlists)
+
+    def user_playlist(self, user, playlist_id=None, fields=None, market=None):
+        self._call("user_playlist")
+        return self._summary(playlist_id)
+
+    def playlist(self, playlist_id, fields=None, market=None, additional_types=("track",)):
+        self._call("playlist")
+        return self._summary(playlist_id)
+
+    def user_playlist_tracks(self, user=None, playlist_id=None, fields=None, limit=100, offset=0, market=None):
+        self._call("user_playlist_tracks")
+        source = lambda limit, offset: self.user_playlist_tracks(user, playlist_id, fields, limit, offset, market)
+        page = self._page(self.playlists[playlist_id]["uris"], limit, offset, source)
+        page["items"] = [{"track": self._track(uri)} for uri in page["items"]]
+        return page
+
+    def next(self, result):
+        if result["next"]:
+            source, limit, offset = result["next"]
+            return source(limit=limit, offset=offset)
+        return None
+
+    def audio_features(self, tracks=[]):
+        self._call("audio_features")
+        return [self._features(uri) for uri in tracks]
+
+    def recommendations(self, seed_artists=None, seed_genres=None, seed_tracks=None, limit=20, country=None, **kwargs):
+        self._call("recommendations")
+        return {"tracks": [self._track(self._new_uri()) for _ in range(limit)]}
+
+    def user_playlist_create(self, user, name, public=True, collaborative=False, description=""):
+        self._call("user_playlist_create")
+        return {"id": self._create(name, [], user)}
+
+    def user_playlist_add_tracks(self, user, playlist_id, tracks, position=None):
+        self._call("user_playlist_add_tracks")
+        if len(tracks) > 100:
+            raise SpotifyException(400, -1, "Too many tracks")
+        return self._edit(playlist_id, lambda uris: uris + list(tracks))
+
+    def user_playlist_replace_tracks(self, user, playlist_id, tracks):
+        self._call("user_playlist_replace_tracks")
+        if len(tracks) > 100:
+            raise SpotifyException(400, -1, "Too many tracks")
+        return self._edit(playlist_id, lambda uris: list(tracks))
+
+    def user_playlist_remove_specific_occurrences_of_tracks(self, user, playlist_id, tracks, snapshot_id=None):
+        self._call("user_playlist_remove_specific_occurrences_of_tracks")
+        if len(tracks) > 100:
+            raise SpotifyException(400, -1, "Too many tracks")
+        positions = {position for track in tracks for position in track["positions"]}
+        return self._edit(playlist_id, lambda uris: [uri for i, uri in enumerate(uris) if i not in positions])
+
+    # Helpers
+
+    def _call(self, method):
+        with self._lock:
+            self.calls[method] += 1
+            self._n_calls += 1
+            rate_limited = self.rate_limit_every and self._n_calls % self.rate_limit_every == 0
+
+        time.sleep(self.latency)
+        if rate_limited:
+            self.calls["429"] += 1
+            raise SpotifyException(429, -1, "Too many requests", headers={"Retry-After": str(self.retry_after)})
+
+    def _page(self, items, limit, offset, source):
+        has_next = offset + limit < len(items)
+        return {
+            "items": items[offset:offset+limit],
+            "total": len(items),
+            "limit": limit,
+            "offset": offset,
+            "next": (source, limit, offset + limit) if has_next else None
+        }
+
+    def _create(self, name, uris, owner):
+        with self._lock:
+            playlist_id = f"playlist{len(self.playlists):06d}"
+            self.playlists[playlist_id] = {"name": name, "uris": uris, "owner": owner, "version": 0}
+        return playlist_id
+
+    def _edit(self, playlist_id, change):
+        with self._lock:
+            playlist = self.playlists[playlist_id]
+            playlist["uris"] = change(playlist["uris"])
+            playlist["version"] += 1
+            return {"snapshot_id": self._snapshot_id(playlist_id)}
+
+    def _snapshot_id(self, playlist_id):
+        return f"{playlist_id}-{self.playlists[playlist_id]['version']}"
+
+    def _summary(self, playlist_id):
+        playlist = self.playlists[playlist_id]
+        return {
+            "id": playlist_id,
+            "name": playlist["name"],
+            "snapshot_id": self._snapshot_id(playlist_id),
+            "owner": {"id": playlist["owner"]},
+            "images": [{"url": ""}],
+            "tracks": {"total": len(playlist["uris"])}
+        }
+
+    def _new_uri(self):
+        with self._lock:
+            self._n_tracks += 1
+            return f"spotify:track:{self._n_tracks:022d}"
+
+    def _track(self, uri):
+        index = int(uri.rsplit(":", 1)[1])
+        artist = index % self.n_artists
+        return {
+            "uri": uri,
+            "id": uri.rsplit(":", 1)[1],
+            "name": f"Track {index}",
+            "artists": [{"id": f"artist{artist:06d}", "name": f"Artist {artist}"}]
+        }
+
+    def _features(self, uri):
+        rng = random.Random(uri)
+        features = {feature: rng.random() for feature in FEATURES}
+        features["loudness"] = -60 * features["loudness"]
+        features["uri"] = uri
+        return features
@@ -0,0 +1,406 @@
+import os
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Defaults for the shared caches, overridable through the environment
+DEFAULT_MAX_SIZE = 50000
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+class LRUCache:
+    """In-process cache with TTL and least-recently-used eviction.
+
+    Thread-safe mapping from keys to values. Entries expire after the TTL and the least recently used
+    entries are evicted once the cache holds more than max_size entries, or more than max_size in total weight
+    if a weigh function is given, e.g. the number of tracks in each value, so memory is bounded by the size of
+    the values rather than their number. Hits, misses and evictions are counted so the cache's effectiveness
+    can be checked.
+
+    Args:
+        max_size (int): Maximum number of entries, or total weight, to hold
+        ttl (float): Seconds an entry stays valid, or None to never expire
+        weigh (callable): Function returning the weight of a value, or None to count entries
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL, weigh=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.weigh = weigh
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Retrieves a value from the cache.
+
+        Args:
+            key (hashable): Key to look up
+            default (object): Value to return if the key is missing or expired
+
+        Returns:
+            object: Cached value, or default
+        """
+
+        with self._lock:
+            return self._get(key, default, time.time())
+
+    def get_many(self, keys):
+        """Retrieves several values from the cache at once.
+
+        Args:
+            keys (iterable): Keys to look up
+
+        Returns:
+            dict: Mapping of the keys that were found to their values
+        """
+
+        found = {}
+        now = time.time()
+        missing = object()
+        with self._lock:
+            for key in keys:
+                value = self._get(key, missing, now)
+                if value is not missing:
+                    found[key] = value
+
+        return found
+
+    def set(self, key, value):
+        """Stores a value in the cache, evicting old entries if needed.
+
+        Args:
+            key (hashable): Key to store the value under
+            value (object): Value to store
+
+        Returns:
+            None
+        """
+
+        with self._lock:
+            self._set(key, value, time.time())
+
+    def set_many(self, mapping):
+        """Stores several values in the cache at once.
+
+        Args:
+            mapping (dict): Mapping of keys to values
+
+        Returns:
+            None
+        """
+
+        now = time.time()
+        with self._lock:
+            for key, value in mapping.items():
+                self._set(key, value, now)
+
+    def delete(self, key):
+        """Removes a key from the cache if present.
+
+        Args:
+            key (hashable): Key to remove
+
+        Returns:
+            None
+        """
+
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        """Removes every entry and resets the counters."""
+
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Returns the cache's counters.
+
+        Returns:
+            dict: Size, hits, misses, evictions and hit rate
+        """
+
+        with self._lock:
+            size = len(self._data)
+        return _stats(size, self.hits, self.misses, self.evictions)
+
+    def __len__(self):
+        return len(self._data)
+
+    def _get(self, key, default, now):
+        entry = self._data.get(key)
+        if entry is None or (entry[0] is not None and entry[0] < now):
+            if entry is not None:
+                self._pop(key)
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def _set(self, key, value, now):
+        expires_at = now + self.ttl if self.ttl is not None else None
+        weight = self.weigh(value) if self.weigh is not None else 1
+        self._pop(key)
+        self._data[key] = (expires_at, value, weight)
+        self.weight += weight
+        while self.weight > self.max_size:
+            self.weight -= self._data.popitem(last=False)[1][2]
+            self.evictions += 1
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[2]
+
+class SQLiteCache:
+    """On-disk cache with TTL and least-recently-used eviction.
+
+    Same interface as LRUCache, but entries are pickled into a SQLite database so they survive restarts
+    and are shared between the processes of a gunicorn deployment. Each thread gets its own connection.
+
+    Args:
+        path (str): Path to the SQLite database file
+        max_size (int): Maximum number of entries to hold
+        ttl (float): Seconds an entry stays valid, or None to never expire
+        namespace (str): Table name, so several caches can share one database file
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL, namespace="cache"):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        with self._connect() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {namespace} "
+                "(key TEXT PRIMARY KEY, value BLOB, expires_at REAL, accessed_at REAL)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {namespace}_accessed ON {namespace} (accessed_at)")
+
+    def get(self, key, default=None):
+        """Retrieves a value from the cache.
+
+        Args:
+            key (str): Key to look up
+            default (object): Value to return if the key is missing or expired
+
+        Returns:
+            object: Cached value, or default
+        """
+
+        found = self.get_many([key])
+        return found.get(key, default)
+
+    def get_many(self, keys):
+        """Retrieves several values from the cache at once.
+
+        Args:
+            keys (iterable): Keys to look up
+
+        Returns:
+            dict: Mapping of the keys that were found to their values
+        """
+
+        keys = list(keys)
+        found = {}
+        now = time.time()
+        conn = self._connect()
+
+        # SQLite limits the number of bound parameters per statement
+        for offset in range(0, len(keys), 500):
+            chunk = [str(key) for key in keys[offset:offset+500]]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT key, value, expires_at FROM {self.namespace} WHERE key IN ({placeholders})", chunk
+            ).fetchall()
+            for key, value, expires_at in rows:
+                if expires_at is None or expires_at >= now:
+                    found[key] = pickle.loads(value)
+
+        if found:
+            with conn:
+                conn.executemany(
+                    f"UPDATE {self.namespace} SET accessed_at = ? WHERE key = ?", [(now, key) for key in found]
+                )
+
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        return {key: found[str(key)] for key in keys if str(key) in found}
+
+    def set(self, key, value):
+        """Stores a value in the cache, evicting old entries if needed.
+
+        Args:
+            key (str): Key to store the value under
+            value (object): Picklable value to store
+
+        Returns:
+            None
+        """
+
+        self.set_many({key: value})
+
+    def set_many(self, mapping):
+        """Stores several values in the cache at once.
+
+        Args:
+            mapping (dict): Mapping of keys to picklable values
+
+        Returns:
+            None
+        """
+
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl is not None else None
+        rows = [
+            (str(key), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), expires_at, now)
+            for key, value in mapping.items()
+        ]
+
+        conn = self._connect()
+        with conn:
+            conn.executemany(f"INSERT OR REPLACE INTO {self.namespace} VALUES (?, ?, ?, ?)", rows)
+            self._evict(conn, now)
+
+    def delete(self, key):
+        """Removes a key from the cache if present.
+
+        Args:
+            key (str): Key to remove
+
+        Returns:
+            None
+        """
+
+        conn = self._connect()
+        with conn:
+            conn.execute(f"DELETE FROM {self.namespace} WHERE key = ?", (str(key),))
+
+    def clear(self):
+        """Removes every entry and resets the counters."""
+
+        conn = self._connect()
+        with conn:
+            conn.execute(f"DELETE FROM {self.namespace}")
+        with self._lock:
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Returns the cache's counters.
+
+        Returns:
+            dict: Size, hits, misses, evictions and hit rate
+        """
+
+        return _stats(len(self), self.hits, self.misses, self.evictions)
+
+    def __len__(self):
+        return self._connect().execute(f"SELECT COUNT(*) FROM {self.namespace}").fetchone()[0]
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+
+        return conn
+
+    def _evict(self, conn, now):
+        conn.execute(f"DELETE FROM {self.namespace} WHERE expires_at < ?", (now,))
+        excess = conn.execute(f"SELECT COUNT(*) FROM {self.namespace}").fetchone()[0] - self.max_size
+        if excess > 0:
+            conn.execute(
+                f"DELETE FROM {self.namespace} WHERE key IN "
+                f"(SELECT key FROM {self.namespace} ORDER BY accessed_at LIMIT ?)", (excess,)
+            )
+            with self._lock:
+                self.evictions += excess
+
+def create_cache(namespace, max_size=None, ttl=None, weigh=None):
+    """Creates a cache using the backend configured in the environment.
+
+    Uses an on-disk SQLiteCache if LAZIFY_CACHE_PATH is set, otherwise an in-process LRUCache. The size and
+    TTL default to LAZIFY_CACHE_MAX_SIZE and LAZIFY_CACHE_TTL. On disk, where the values don't take up
+    process memory, max_size always counts entries.
+
+    Args:
+        namespace (str): Name of the cache, used as the SQLite table name
+        max_size (int): Maximum number of entries, or total weight, overriding the environment
+        ttl (float): Seconds an entry stays valid, overriding the environment
+        weigh (callable): Function returning the weight of a value for an in-process cache, see LRUCache
+
+    Returns:
+        LRUCache or SQLiteCache: The new cache
+    """
+
+    if max_size is None:
+        max_size = int(os.getenv("LAZIFY_CACHE_MAX_SIZE", DEFAULT_MAX_SIZE))
+    if ttl is None:
+        ttl = float(os.getenv("LAZIFY_CACHE_TTL", DEFAULT_TTL))
+
+    path = os.getenv("LAZIFY_CACHE_PATH")
+    if path:
+        return SQLiteCache(path, max_size=max_size, ttl=ttl, namespace=namespace)
+
+    return LRUCache(max_size=max_size, ttl=ttl, weigh=weigh)
+
+def _stats(size, hits, misses, evictions):
+    total = hits + misses
+    return {
+        "size": size,
+        "hits": hits,
+        "misses": misses,
+        "evictions": evictions,
+        "hit_rate": hits / total if total else 0.0
+    }
+
+def _count_tracks(value):
+    # Number of tracks in a cached playlist, artist index or model, 1 for anything else such as a snapshot id
+    if isinstance(value, list):
+        return max(len(value), 1)
+    if isinstance(value, dict) and "uris" in value:
+        return max(len(value["uris"]), 1)
+    if isinstance(value, dict):
+        return max(sum(len(artist["uris"]) for artist in value.values()), 1)
+    return 1
+
+def _count_playlists(value):
+    return max(len(value["playlists"]), 1)
+
+# Every gunicorn worker has its own in-process caches, so each can use roughly the sum of these bounds. Measured
+# on CPython 3.11, a track costs about 0.7 KB in the feature cache, 0.4 KB in the playlist cache and 0.1 KB in
+# the artist index and model caches, and a playlist about 0.7 KB in the catalog cache, so the defaults below
+# come to about 150 MB per worker at most.
+
+# Audio features keyed by track uri, bounded by number of tracks, and playlist contents keyed by playlist id +
+# snapshot id, bounded by the total number of tracks
+feature_cache = create_cache("audio_features")
+playlist_cache = create_cache("playlist_tracks", max_size=100000, weigh=_count_tracks)
+
+# Artist indexes keyed by the selected playlists' ids + snapshot ids, bounded by the total number of tracks
+artist_index_cache = create_cache("artist_index", max_size=100000, weigh=_count_tracks)
+
+# Playlist listings keyed by user id, bounded by the total number of playlists
+catalog_cache = create_cache("playlist_catalog", max_size=50000, weigh=_count_playlists)
+
+# Scalers, PCA and clusterings keyed by a hash of the selection's track uris, bounded by the total number of
+# tracks
+model_cache = create_cache("models", max_size=200000, weigh=_count_tracks)
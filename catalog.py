@@ -0,0 +1,107 @@
+import os
+import time
+from cache import catalog_cache
+from fetch import call_with_retry, parallel_map
+
+# Number of playlists per page, the most the API returns at once
+PAGE_SIZE = 50
+# Seconds after which the whole listing is fetched again, even if its first page hasn't changed
+MAX_AGE = float(os.getenv("LAZIFY_CATALOG_MAX_AGE", 10 * 60))
+
+class PlaylistCatalog:
+    """Every playlist in a user's library, with lookups by id and by name.
+
+    Args:
+        playlists (list): List of playlist summaries, in the order the API lists them
+    """
+
+    def __init__(self, playlists):
+        self.playlists = playlists
+        self.by_id = {playlist["id"]: playlist for playlist in playlists}
+        self.by_name = {}
+        for playlist in playlists:
+            self.by_name.setdefault(playlist["name"], playlist["id"])
+
+    def find(self, name):
+        """Looks up a playlist by name.
+
+        Args:
+            name (str): Name of the playlist
+
+        Returns:
+            str: Id for the first playlist with that name, or None if there is none
+        """
+
+        return self.by_name.get(name)
+
+    def __len__(self):
+        return len(self.playlists)
+
+    def __iter__(self):
+        return iter(self.playlists)
+
+def get_catalog(spotify, user_id, max_age=MAX_AGE):
+    """Retrieves every playlist in the user's library, using the shared catalog cache.
+
+    Always fetches the first page of the listing. If the total and every playlist and snapshot id on that page
+    match the cached listing, the cached listing is returned, so a refresh usually costs a single call. Otherwise,
+    or once the cached listing is older than max_age, the remaining pages are fetched concurrently. Playlists
+    past the first page can therefore be listed with an outdated name or snapshot id for up to max_age, so the
+    snapshot ids are only good for display, not as cache keys for the playlists' tracks.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object
+        user_id (str): Spotify user id
+        max_age (float): Seconds a cached listing can be reused for without fetching every page again
+
+    Returns:
+        PlaylistCatalog: The user's playlists
+    """
+
+    now = time.time()
+    first = call_with_retry(spotify.current_user_playlists, limit=PAGE_SIZE, offset=0)
+    head = [_summary(playlist) for playlist in first["items"] if playlist is not None]
+
+    cached = catalog_cache.get(user_id)
+    if cached is not None and now - cached["fetched_at"] < max_age and _unchanged(cached, first["total"], head):
+        return PlaylistCatalog(cached["playlists"])
+
+    playlists = head
+    pages = parallel_map(
+        lambda offset: call_with_retry(spotify.current_user_playlists, limit=PAGE_SIZE, offset=offset),
+        range(PAGE_SIZE, first["total"], PAGE_SIZE)
+    )
+    for page in pages:
+        playlists.extend(_summary(playlist) for playlist in page["items"] if playlist is not None)
+
+    catalog_cache.set(user_id, {"playlists": playlists, "total": first["total"], "fetched_at": now})
+    return PlaylistCatalog(playlists)
+
+def invalidate(user_id):
+    """Drops the user's cached listing, so the next lookup fetches every page.
+
+    Args:
+        user_id (str): Spotify user id
+
+    Returns:
+        None
+    """
+
+    catalog_cache.delete(user_id)
+
+def _unchanged(cached, total, head):
+    if cached["total"] != total:
+        return False
+    cached_head = cached["playlists"][:len(head)]
+    return [(p["id"], p["snapshot_id"]) for p in cached_head] == [(p["id"], p["snapshot_id"]) for p in head]
+
+def _summary(playlist):
+    images = playlist.get("images") or [{}]
+    return {
+        "id": playlist["id"],
+        "name": playlist["name"],
+        "snapshot_id": playlist.get("snapshot_id"),
+        "owner_id": (playlist.get("owner") or {}).get("id"),
+        "image_url": images[0].get("url", ""),
+        "tracks": (playlist.get("tracks") or {}).get("total", 0)
+    }
@@ -0,0 +1,169 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+from spotipy.exceptions import SpotifyException
+from instrumentation import count_retry, in_current_context
+
+# Bounds for concurrent requests and retries, overridable through the environment
+MAX_WORKERS = int(os.getenv("LAZIFY_FETCH_WORKERS", 8))
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# Fields requested at each call site, so responses only carry what is used
+FIELDS = {
+    "playlist_info": "name,snapshot_id,tracks.total",
+    "playlist_tracks": "items(track(uri,name,artists(id,name))),total",
+    "playlist_uris": "items(track(uri)),total"
+}
+
+# Market for track relinking, e.g. "from_token", or None to leave it to the API
+MARKET = os.getenv("LAZIFY_MARKET") or None
+
+def call_with_retry(function, *args, **kwargs):
+    """Calls a Spotify API method, retrying when rate limited or on server errors.
+
+    Calls the function and, if the Spotify API responds with 429 Too Many Requests, waits for the number of
+    seconds given by the Retry-After header before trying again. Server errors are retried with exponential
+    backoff.
+
+    Args:
+        function (callable): Spotify API method to call
+        *args: Positional arguments for the function
+        **kwargs: Keyword arguments for the function
+
+    Returns:
+        object: Result of the function
+    """
+
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return function(*args, **kwargs)
+        except SpotifyException as e:
+            delay = retry_delay(e, attempt)
+            if delay is None:
+                raise
+            count_retry(e.http_status)
+            time.sleep(delay)
+
+def retry_delay(error, attempt):
+    """Decides whether and when to retry a failed Spotify API call.
+
+    Args:
+        error (spotipy.SpotifyException): Error raised by the Spotify API
+        attempt (int): Number of attempts that have failed before this one
+
+    Returns:
+        float: Seconds to wait before retrying, or None if the call shouldn't be retried
+    """
+
+    if attempt >= MAX_RETRIES:
+        return None
+    if error.http_status == 429:
+        return retry_after(error)
+    if error.http_status in RETRY_STATUSES:
+        return BACKOFF_FACTOR * 2 ** attempt
+
+    return None
+
+def retry_after(error, default=1.0):
+    """Reads the number of seconds to wait from a rate limit error.
+
+    Args:
+        error (spotipy.SpotifyException): Error raised by the Spotify API
+        default (float): Seconds to wait if the response has no Retry-After header
+
+    Returns:
+        float: Seconds to wait before retrying
+    """
+
+    try:
+        return max(float(error.headers.get("Retry-After", default)), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+def fetch_pages(fetch_page, limit, max_workers=MAX_WORKERS):
+    """Retrieves every item of a paged Spotify API resource.
+
+    Fetches the first page to learn the total number of items, then fetches the remaining pages concurrently
+    with a bounded thread pool. Items are returned in the same order as walking the "next" links.
+
+    Args:
+        fetch_page (callable): Function taking an offset and returning the page at that offset
+        limit (int): Number of items per page
+        max_workers (int): Maximum number of pages to fetch at once
+
+    Returns:
+        list: List of items from every page
+    """
+
+    return list(chain.from_iterable(iter_pages(fetch_page, limit, max_workers)))
+
+def iter_pages(fetch_page, limit, max_workers=MAX_WORKERS):
+    """Yields the items of a paged Spotify API resource one page at a time.
+
+    Fetches the first page to learn the total number of items, then keeps up to max_workers of the following
+    pages in flight while earlier pages are consumed. Pages are yielded in order, so callers can process a large
+    resource as it downloads while only a few pages are held in memory.
+
+    Args:
+        fetch_page (callable): Function taking an offset and returning the page at that offset
+        limit (int): Number of items per page
+        max_workers (int): Maximum number of pages to fetch at once
+
+    Yields:
+        list: Items of the next page
+    """
+
+    first = call_with_retry(fetch_page, 0)
+    yield first["items"]
+    total = first.get("total")
+
+    # Fall back to following the next links if the total is unknown
+    if total is None:
+        page, count = first, len(first["items"])
+        while page["next"]:
+            page = call_with_retry(fetch_page, count)
+            count += len(page["items"])
+            yield page["items"]
+        return
+
+    offsets = iter(range(limit, total, limit))
+    fetch = in_current_context(call_with_retry)
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        pending = deque(executor.submit(fetch, fetch_page, offset) for offset in islice(offsets, max_workers))
+        try:
+            while pending:
+                page = pending.popleft().result()
+                offset = next(offsets, None)
+                if offset is not None:
+                    pending.append(executor.submit(fetch, fetch_page, offset))
+                yield page["items"]
+        finally:
+            # Don't fetch the rest if the caller stops early
+            for future in pending:
+                future.cancel()
+
+def parallel_map(function, items, max_workers=MAX_WORKERS):
+    """Applies a function to every item concurrently.
+
+    Runs the calls on a bounded thread pool and returns the results in the same order as the items. Used to
+    fetch several pages or playlists at once.
+
+    Args:
+        function (callable): Function to apply
+        items (iterable): Items to apply the function to
+        max_workers (int): Maximum number of concurrent calls
+
+    Returns:
+        list: List of results, in the same order as items
+    """
+
+    items = list(items)
+    if len(items) <= 1 or max_workers <= 1:
+        return [function(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(in_current_context(function), items))
@@ -1,162 +1,240 @@
 import os
+import random
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 # Work around for Fortran and Ctrl+C handling
 os.environ["FOR_DISABLE_CONSOLE_CTRL_HANDLER"] = "1"
 
-import spotipy as sp
-import pandas as pd
-import numpy as np
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.decomposition import PCA
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
-from sklearn.metrics.pairwise import cosine_similarity
-
-def cluster(spotify, user_id, selected_playlists):
+from cache import artist_index_cache, feature_cache, playlist_cache
+from catalog import get_catalog
+from fetch import FIELDS, MARKET, MAX_WORKERS, call_with_retry, fetch_pages, iter_pages, parallel_map
+from instrumentation import in_current_context, stage
+from jobs import report_progress
+from models import CHUNK_SIZE, STREAMING_THRESHOLD, FeatureBuffer, cluster_buffer, cluster_tracks, scale_features
+from ranking import rank_candidates
+from track_store import track_store
+from track_table import FEATURES, build_track_table, feature_matrix
+from writer import PlaylistStream, iter_write_playlists, write_playlists
+
+logger = logging.getLogger(__name__)
+
+# Number of unique recommended tracks to rank, overridable through the environment
+RECOMMENDATION_POOL = int(os.getenv("LAZIFY_RECOMMENDATION_POOL", 500))
+# Times a playlist is read again for duplicate removal if it changes while being read
+SNAPSHOT_ATTEMPTS = 3
+
+def cluster(spotify, user_id, selected_playlists, strategy=None):
     """Groups tracks into clusters based on audio features using K-means.
     
     Retrieves tracks from selected playlists and their relevant audio features, performs PCA on the features,
     and then clusters the features using K-means into optimal number of clusters based on silhouette score.
+    Selections of at least LAZIFY_STREAMING_THRESHOLD tracks are clustered out of core instead, see
+    models.cluster_buffer, bypassing the in-process caches. Their audio features are then never all in memory;
+    only the selection's uris and cluster labels, and the tracks of the playlist being downloaded (at most
+    10,000), are.
 
     Args:
         spotify (spotipy.Spotify): Spotify API object
         user_id (str): Spotify user id
         selected_playlists (list): List of ids for the selected playlists
+        strategy (str): Strategy for choosing the number of clusters, see model_selection.select_k
     
     Returns:
         list: List of ids for the newly created playlists     
     """
 
-    data = pd.DataFrame()
-    for playlist in selected_playlists:
-        df = get_track_features(spotify, user_id, playlist)[["uri", "acousticness", "danceability", "energy", "instrumentalness", "liveness", "loudness", "speechiness", "valence"]]
-        data = data.append(df)
-    data = data.drop_duplicates()
+    new_playlists = _cluster_playlists(spotify, user_id, selected_playlists, strategy)
+    return [report["id"] for report in write_playlists(spotify, user_id, new_playlists)]
+
+def iter_cluster(spotify, user_id, selected_playlists, strategy=None):
+    """Groups tracks into clusters like cluster, yielding each new playlist as soon as it is written.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object
+        user_id (str): Spotify user id
+        selected_playlists (list): List of ids for the selected playlists
+        strategy (str): Strategy for choosing the number of clusters, see model_selection.select_k
+
+    Yields:
+        str: Id for a newly created playlist, in the order the playlists finish
+    """
+
+    new_playlists = _cluster_playlists(spotify, user_id, selected_playlists, strategy)
+    for report in iter_write_playlists(spotify, user_id, new_playlists):
+        yield report["id"]
 
-    # Normalize audio feature data
-    scaler = MinMaxScaler()
-    data_std = scaler.fit_transform(data.iloc[:, 1:])
+def _cluster_playlists(spotify, user_id, selected_playlists, strategy):
+    report_progress("Getting your tracks")
+    infos = parallel_map(lambda playlist: get_playlist_info(spotify, user_id, playlist), selected_playlists)
+    total = sum(info["tracks"]["total"] for info in infos)
+    if total >= STREAMING_THRESHOLD:
+        return _cluster_playlists_out_of_core(spotify, user_id, selected_playlists, infos, total, strategy)
 
-    # PCA
-    # Arbitrarily chose 0.8 as cutoff for explained variance
-    pca = PCA(n_components=0.8)
-    reduced = pca.fit_transform(data_std)
+    data = get_track_table(spotify, user_id, selected_playlists, [info["snapshot_id"] for info in infos])
 
-    # Find optimal number of clusters using silhouette score
+    # Normalize, reduce and cluster the audio features, reusing the models fitted for the same tracks before
     # Arbitrarily chose 20 as max number of clusters
-    N_MAX = 20
-    silhouette_scores = []
-    for i in range(2, N_MAX + 1):
-        clusterer = KMeans(n_clusters=i, init="k-means++", random_state=1738)
-        cluster_labels = clusterer.fit_predict(reduced)
-        silhouette_scores.append(silhouette_score(reduced, cluster_labels))
-    n_clusters = np.argmax(silhouette_scores) + 2
-
-    # Cluster
-    kmeans = KMeans(n_clusters=n_clusters, init="k-means++", random_state=1738)
-    cluster_labels = kmeans.fit_predict(reduced)
-    data["cluster"] = cluster_labels
+    report_progress(f"Clustering {len(data)} tracks")
+    n_clusters, labels = cluster_tracks(data, strategy=strategy, k_max=20)
+    data["cluster"] = labels
 
     # Make new playlists
-    selected_playlists_names = [spotify.user_playlist(user_id, playlist)["name"] for playlist in selected_playlists]
-    new_playlist_ids = []
+    report_progress("Making your playlists")
+    selected_playlists_names = [info["name"] for info in infos]
+    new_playlists = []
     for i in range(n_clusters):
         uris = data[data["cluster"] == i]["uri"].tolist()
         name = "[Lazify] Cluster #" + str(i + 1) + ": " + " + ".join(selected_playlists_names)
-        new_playlist_ids.append(make_playlist(spotify, user_id, name, uris))
-    
-    return new_playlist_ids
+        new_playlists.append({"name": name, "uris": uris})
+
+    return new_playlists
 
-def recommend(spotify, user_id, selected_playlists):
+def _cluster_playlists_out_of_core(spotify, user_id, selected_playlists, infos, total, strategy):
+    # Stream the tracks playlist by playlist and their audio features chunk by chunk into a memory-mapped
+    # buffer, keeping only the uris in memory, then cluster the buffer a chunk at a time. Tracks and audio
+    # features go to the track store only, since the in-process caches would keep every one of them.
+    report_progress("Getting your tracks")
+    seen = set()
+    uris = []
+    pending = []
+    with FeatureBuffer(total) as buffer:
+        def flush():
+            features = get_audio_features(spotify, pending, cache=False)
+            rows = [[track_features[feature] for feature in FEATURES] for track_features in features if track_features is not None]
+            if rows:
+                buffer.append(rows)
+            uris.extend(uri for uri, track_features in zip(pending, features) if track_features is not None)
+            pending.clear()
+
+        for playlist, info in zip(selected_playlists, infos):
+            for track in iter_playlist_tracks(spotify, user_id, playlist, info["snapshot_id"], cache=False):
+                if track[0] not in seen:
+                    seen.add(track[0])
+                    pending.append(track[0])
+                    if len(pending) >= CHUNK_SIZE:
+                        flush()
+        if pending:
+            flush()
+        seen.clear()
+        if not uris:
+            return []
+
+        # Arbitrarily chose 20 as max number of clusters
+        report_progress(f"Clustering {len(buffer)} tracks")
+        n_clusters, labels = cluster_buffer(buffer, strategy=strategy, k_max=20)
+
+    # Make new playlists
+    report_progress("Making your playlists")
+    selected_playlists_names = [info["name"] for info in infos]
+    clusters = [[] for _ in range(n_clusters)]
+    for uri, label in zip(uris, labels.tolist()):
+        clusters[label].append(uri)
+
+    new_playlists = []
+    for cluster_uris in clusters:
+        if cluster_uris:
+            name = "[Lazify] Cluster #" + str(len(new_playlists) + 1) + ": " + " + ".join(selected_playlists_names)
+            new_playlists.append({"name": name, "uris": cluster_uris})
+
+    return new_playlists
+
+def recommend(spotify, user_id, selected_playlists, aggregate="max"):
     """Create a playlist of recommended tracks based on the selected playlists.
 
     Retrieve recommended tracks from the Spotify API, using the tracks in the selected playlists as seed tracks,
-    and then create a new playlist with the top 25 tracks with the highest cosine similarity to the seed tracks.
-    The number of similarity scores relies on the number of seed tracks, so if there are less than 25 seed tracks,
-    just randomly select 25 tracks from the recommended tracks.
+    and then create a new playlist with the top 25 distinct tracks with the highest cosine similarity to the seed
+    tracks. A track's similarity to the seed tracks is its best (or mean) similarity across all of them.
 
     Args:
         spotify (spotipy.Spotify): Spotify API object
         user_id (str): Spotify user id
         selected_playlists (list): List of ids for the selected playlists
+        aggregate (str): How to combine a track's similarity across the seed tracks, "max" or "mean"
     
     Returns:
         list: List containing the id for the newly created playlist, to bypass iteration in app.py
     """
     
-    playlist_names = []
-    data = pd.DataFrame()
-    for playlist in selected_playlists:
-        playlist_names.append(spotify.user_playlist(user_id, playlist)["name"])
-        df = get_track_features(spotify, user_id, playlist)[["uri", "acousticness", "danceability", "energy", "instrumentalness", "liveness", "loudness", "speechiness", "valence"]]
-        data = data.append(df)
-    data = data.drop_duplicates()
+    report_progress("Getting your tracks")
+    infos = parallel_map(lambda playlist: get_playlist_info(spotify, user_id, playlist), selected_playlists)
+    playlist_names = [info["name"] for info in infos]
+    data = get_track_table(spotify, user_id, selected_playlists, [info["snapshot_id"] for info in infos])
     new_name = "[Lazify] Recommended: " + " + ".join(playlist_names)
 
     # Track info for recommended tracks
-    seeds = data["uri"].tolist()
-    offset = 0
-    uris = []
-    while offset < len(data):
-        results = spotify.recommendations(seed_tracks=seeds[offset:offset+5], limit=25)
-        tracks = results["tracks"]
-        for track in tracks:
-            uris.append(track["uri"])
-        offset += 5
+    report_progress("Finding recommendations")
+    with stage("recommendations"):
+        tracks = get_recommendations(spotify, data["uri"].tolist())
     
-    # Audio features for recommended tracks
-    offset = 0
-    all_features = []
-    acousticness, danceability, energy, instrumentalness, liveness, loudness, speechiness, valence = [], [], [], [], [], [], [], []
+    # Make recommendations dataframe with the audio features
+    uris = [track[0] for track in tracks]
+    features = dict(zip(uris, get_audio_features(spotify, uris)))
+    recommendations = build_track_table([tracks], features)
+
+    # Pick the 25 tracks with the highest cosine similarity to the seed tracks
+    scaler, seed_features_scaled = scale_features(data)
+    recommendations_scaled = scaler.transform(feature_matrix(recommendations))
+    with stage("ranking"):
+        top = rank_candidates(seed_features_scaled, recommendations_scaled, k=25, aggregate=aggregate)
+    final_recommendations = recommendations.iloc[top]
 
-    while offset < len(uris):
-        all_features += spotify.audio_features(uris[offset:offset+100])
-        offset += 100
-    
-    for features in all_features:
-        acousticness.append(features["acousticness"])
-        danceability.append(features["danceability"])
-        energy.append(features["energy"])
-        instrumentalness.append(features["instrumentalness"])
-        liveness.append(features["liveness"])
-        loudness.append(features["loudness"])
-        speechiness.append(features["speechiness"])
-        valence.append(features["valence"])
-
-    # Combine everything
-    rec = {
-            "uri": uris,
-            "acousticness": acousticness,
-            "danceability": danceability,
-            "energy": energy,
-            "instrumentalness": instrumentalness,
-            "liveness": liveness,
-            "loudness": loudness,
-            "speechiness": speechiness,
-            "valence": valence
-        }
+    return [make_playlist(spotify, user_id, new_name, final_recommendations["uri"].tolist())]
     
-    # Make recommendations dataframe, removing duplicates and any tracks that were in the seed tracks
-    recommendations = pd.DataFrame(rec)
-    recommendations = recommendations.drop_duplicates()
-    recommendations = recommendations[~recommendations["uri"].isin(data["uri"])]
-    recommendations = recommendations.reset_index(drop=True)
-
-    # Randomly select 25 tracks from the recommendations dataframe if there were less than 25 seed tracks
-    if len(seeds) < 25:
-        recommendations = recommendations.sample(n=25)
-        return [make_playlist(spotify, user_id, new_name, recommendations["uri"].tolist())]
-
-    # Calculate cosine similarity scores for each track otherwise
-    scaler = MinMaxScaler()
-    seed_features_scaled = scaler.fit_transform(data.iloc[:, 1:])
-    recommendations_scaled = scaler.transform(recommendations.iloc[:, 1:])
-    cosine_similarity_scores = cosine_similarity(seed_features_scaled, recommendations_scaled)
-    final_recommendations = recommendations.loc[[np.argmax(i) for i in cosine_similarity_scores]]
-    final_recommendations = final_recommendations.head(25)
+def get_recommendations(spotify, seeds, pool_size=RECOMMENDATION_POOL, max_workers=MAX_WORKERS):
+    """Retrieves recommended tracks for a set of seed tracks.
 
-    return [make_playlist(spotify, user_id, new_name, final_recommendations["uri"].tolist())]
+    Requests recommendations for windows of 5 seed tracks concurrently on a bounded thread pool, and stops
+    requesting once pool_size unique tracks have been collected. The windows are visited in a shuffled order
+    so an early stop still draws on the whole selection.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object
+        seeds (list): List of seed track uris
+        pool_size (int): Number of unique recommended tracks to collect
+        max_workers (int): Maximum number of concurrent requests
     
+    Returns:
+        list: List of unique (uri, name, artist id, artist name) tuples, excluding the seed tracks
+    """
+
+    windows = [seeds[offset:offset+5] for offset in range(0, len(seeds), 5)]
+    random.Random(1738).shuffle(windows)
+
+    @in_current_context
+    def fetch(window):
+        return call_with_retry(spotify.recommendations, seed_tracks=window, limit=25)["tracks"]
+
+    # Keep at most max_workers requests in flight, and stop submitting once the pool is full
+    excluded = set(seeds)
+    results = {}
+    unique = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        next_window = 0
+        while pending or next_window < len(windows):
+            while next_window < len(windows) and len(pending) < max_workers and len(unique) < pool_size:
+                pending[executor.submit(fetch, windows[next_window])] = next_window
+                next_window += 1
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[pending.pop(future)] = future.result()
+                unique.update(track["uri"] for track in future.result() if track["uri"] not in excluded)
+
+    # Assemble in window order so the result doesn't depend on which requests finished first
+    tracks = {}
+    for index in sorted(results):
+        for track in results[index]:
+            if track["uri"] not in excluded and track["uri"] not in tracks:
+                artist = track["artists"][0]
+                tracks[track["uri"]] = (track["uri"], track["name"], artist["id"], artist["name"])
+
+    return list(tracks.values())
+
 def artists(spotify, user_id, selected_artists, selected_playlists):
     """Separates tracks of the selected playlists by the selected artists.
 
@@ -173,43 +251,61 @@ def artists(spotify, user_id, selected_artists, selected_playlists):
         list: List of ids for the newly created or existing playlists
     """
 
-    data = pd.DataFrame()
-    for playlist in selected_playlists:
-        df = get_track_features(spotify, user_id, playlist)[["uri", "artist"]]
-        data = data.append(df)
-    data = data.drop_duplicates()
+    new_playlists = _artist_playlists(spotify, user_id, selected_artists, selected_playlists)
+    new_playlist_ids = [report["id"] for report in write_playlists(spotify, user_id, new_playlists)]
+    return remove_duplicates(spotify, user_id, new_playlist_ids)
+
+def iter_artists(spotify, user_id, selected_artists, selected_playlists):
+    """Separates tracks by artist like artists, yielding each playlist as soon as it is written.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object
+        user_id (str): Spotify user id
+        selected_artists (list): List of ids for the selected artists to separate tracks by
+        selected_playlists (list): List of ids for the selected playlists
+
+    Yields:
+        str: Id for a newly created or existing playlist, in the order the playlists finish
+    """
+
+    new_playlists = _artist_playlists(spotify, user_id, selected_artists, selected_playlists)
+    for report in iter_write_playlists(spotify, user_id, new_playlists):
+        remove_playlist_duplicates(spotify, user_id, report["id"])
+        yield report["id"]
+
+def _artist_playlists(spotify, user_id, selected_artists, selected_playlists):
+    report_progress("Getting your tracks")
+    artist_index = get_artist_index(spotify, user_id, selected_playlists)
 
     # Get user"s current playlists
-    current_playlists = spotify.current_user_playlists()["items"]
-    current_playlist_ids = [playlist["id"] for playlist in current_playlists]
-    current_playlist_names = [playlist["name"] for playlist in current_playlists]
+    catalog = get_catalog(spotify, user_id)
 
     # Make the playlist(s)
-    new_playlist_ids = []
-    for artist in selected_artists:
-        uris = data[data["artist"] == artist]["uri"].tolist()
-        name = "[Lazify] Artist: " + artist
-
-        # Check if playlist for that artist already exists
-        if name in current_playlist_names:
-            index = current_playlist_names.index(name)
-            new_playlist_ids.append(current_playlist_ids[index])
+    report_progress("Making your playlists")
+    new_playlists = []
+    for artist_id in selected_artists:
+        if artist_id not in artist_index:
+            continue
+        uris = artist_index[artist_id]["uris"]
+        name = "[Lazify] Artist: " + artist_index[artist_id]["name"]
 
-            offset = 0
-            while offset < len(uris):
-                spotify.user_playlist_add_tracks(user_id, current_playlist_ids[index], uris[offset:offset+100])
-                offset += 100
+        # Check if playlist for that artist already exists, and add to it if so
+        existing_id = catalog.find(name)
+        if existing_id is not None:
+            new_playlists.append({"id": existing_id, "name": name, "uris": uris})
 
         # If not, make a new playlist
         else:
-            new_playlist_ids.append(make_playlist(spotify, user_id, name, uris))
-    
-    return remove_duplicates(spotify, user_id, new_playlist_ids)
+            new_playlists.append({"name": name, "uris": uris})
+
+    return new_playlists
 
 def merge(spotify, user_id, selected_playlists):
     """Merges two or more playlists into one.
 
-    Creates a new playlist with all of the unique tracks from the selected playlists.
+    Creates a new playlist with all of the unique tracks from the selected playlists, in the order they first
+    appear. The playlists are streamed page by page and tracks are added while later pages are still being
+    fetched, so only the set of tracks seen so far is held in memory.
 
     Args:
         spotify (spotipy.Spotify): Spotify API object
@@ -225,21 +321,30 @@ def merge(spotify, user_id, selected_playlists):
     if len(selected_playlists) == 1:
         return selected_playlists
 
-    uris, names = [], []
-    for playlist in selected_playlists:
-        uris.extend(get_track_uris(spotify, user_id, playlist))
-        names.append(spotify.user_playlist(user_id, playlist)["name"])
-    
-    uris = list(set(uris))
-    new_name = "[Lazify] Merged: " + " + ".join(names)
+    report_progress("Getting your tracks")
+    infos = parallel_map(lambda playlist: get_playlist_info(spotify, user_id, playlist), selected_playlists)
+    new_name = "[Lazify] Merged: " + " + ".join(info["name"] for info in infos)
+    new_playlist_id = call_with_retry(spotify.user_playlist_create, user_id, new_name, public=False)["id"]
+
+    # Add unique tracks in the order they first appear while later pages are still downloading
+    report_progress("Making your playlist")
+    seen = set()
+    with PlaylistStream(spotify, user_id, new_playlist_id) as stream:
+        for playlist, info in zip(selected_playlists, infos):
+            for uri, _, _, _ in iter_playlist_tracks(spotify, user_id, playlist, info["snapshot_id"]):
+                if uri not in seen:
+                    seen.add(uri)
+                    stream.add(uri)
 
-    return [make_playlist(spotify, user_id, new_name, uris)]
+    return [new_playlist_id]
 
 # To-do: Only accounts for identical uris, might be problematic if identical tracks were released as single and in album
 def remove_duplicates(spotify, user_id, selected_playlists):
     """Removes duplicate tracks from playlists.
 
-    Removes any duplicate tracks from each of the selected playlists, modifying them in place.
+    Removes any duplicate tracks from each of the selected playlists, modifying them in place. Only the
+    later occurrences of each track are removed, so the playlist keeps its order, and playlists that haven't
+    changed since they were last cleaned are skipped.
 
     Args:
         spotify (spotipy.Spotify): Spotify API object
@@ -250,23 +355,20 @@ def remove_duplicates(spotify, user_id, selected_playlists):
         list: List of ids for the modified playlists
     """
     
-    for playlist in selected_playlists:
-        uris = get_track_uris(spotify, user_id, playlist)
-        unique_uris = list(set(uris))
-
-        # Skip playlists that don"t contain duplicates
-        if len(unique_uris) == len(uris):
-            continue
-        
-        spotify.user_playlist_replace_tracks(user_id, playlist, unique_uris)
+    report_progress("Removing duplicates")
+    with stage("remove_duplicates"):
+        parallel_map(lambda playlist: remove_playlist_duplicates(spotify, user_id, playlist), selected_playlists)
 
     return selected_playlists
 
-def get_track_uris(spotify, user_id, playlist):
-    """Retrieves track uris for a playlist.
+def remove_playlist_duplicates(spotify, user_id, playlist):
+    """Removes duplicate tracks from a single playlist.
 
-    Retrieves only track uris for a playlist, not including the track"s audio features, which will be
-    more efficient than get_track_features for large playlists.
+    Finds the positions of every repeated track in one pass over the playlist, then removes just those
+    occurrences against the snapshot that was read, in batches of 100 tracks. The snapshot id is read again
+    after the pass, and the playlist read again if it changed in between, since the positions would otherwise
+    be applied to a snapshot they weren't found in. A playlist that keeps changing is left alone. The resulting
+    snapshot id is remembered, so the playlist is skipped next time unless it has changed since.
 
     Args:
         spotify (spotipy.Spotify): Spotify API object
@@ -274,23 +376,53 @@ def get_track_uris(spotify, user_id, playlist):
         playlist (str): Id for the playlist
     
     Returns:
-        list: List of track uris
+        int: Number of tracks removed
     """
 
-    results = spotify.user_playlist_tracks(user_id, playlist)
-    tracks = results["items"]
-    uris = []
+    snapshot_id = get_playlist_info(spotify, user_id, playlist)["snapshot_id"]
+    clean_key = f"{playlist}:clean"
+    for _ in range(SNAPSHOT_ATTEMPTS):
+        if playlist_cache.get(clean_key) == snapshot_id:
+            return 0
+
+        duplicates = _duplicate_positions(spotify, user_id, playlist)
+        current_snapshot_id = get_playlist_info(spotify, user_id, playlist)["snapshot_id"]
+        if current_snapshot_id == snapshot_id:
+            break
+        snapshot_id = current_snapshot_id
+    else:
+        logger.warning("Skipped removing duplicates from %s, which kept changing while being read", playlist)
+        return 0
+
+    tracks = [{"uri": uri, "positions": positions} for uri, positions in duplicates.items()]
+    offset = 0
+    while offset < len(tracks):
+        result = call_with_retry(spotify.user_playlist_remove_specific_occurrences_of_tracks, user_id, playlist, tracks[offset:offset+100], snapshot_id=snapshot_id)
+        offset += 100
 
-    while results["next"]:
-        results = spotify.next(results)
-        tracks.extend(results["items"])
-    
-    for track in tracks:
-        uris.append(track["track"]["uri"])
+    if tracks:
+        snapshot_id = result["snapshot_id"]
+    playlist_cache.set(clean_key, snapshot_id)
 
-    return uris
+    return sum(len(track["positions"]) for track in tracks)
 
-def get_artists(spotify, user_id, selected_playlists):
+def _duplicate_positions(spotify, user_id, playlist):
+    # Positions of every occurrence of a track after its first
+    seen = set()
+    duplicates = {}
+    items = fetch_pages(lambda offset: spotify.user_playlist_tracks(user_id, playlist, fields=FIELDS["playlist_uris"], limit=100, offset=offset, market=MARKET), 100)
+    for position, item in enumerate(items):
+        if item["track"] is None:
+            continue
+        uri = item["track"]["uri"]
+        if uri in seen:
+            duplicates.setdefault(uri, []).append(position)
+        else:
+            seen.add(uri)
+
+    return duplicates
+
+def get_artists(spotify, user_id, selected_playlists, snapshot_ids=None):
     """Retrieves unique artists from playlists.
     
     Retrieves every distinct artist from all of the tracks in the selected playlists.
@@ -299,88 +431,248 @@ def get_artists(spotify, user_id, selected_playlists):
         spotify (spotipy.Spotify): Spotify API object
         user_id (str): Spotify user id
         selected_playlists (list): List of ids for the selected playlists
+        snapshot_ids (list): List of snapshot ids for the selected playlists, if already known
+    
+    Returns:
+        list: List of unique (artist id, artist name) tuples
+    """
+
+    index = get_artist_index(spotify, user_id, selected_playlists, snapshot_ids)
+
+    return [(artist_id, artist["name"]) for artist_id, artist in index.items()]
+
+def get_artist_index(spotify, user_id, selected_playlists, snapshot_ids=None):
+    """Retrieves an index of the tracks of the selected playlists by artist.
+
+    Builds a mapping from each artist to their tracks in a single pass over the selected playlists. The index
+    is cached for the playlists' current snapshots, so the artist selection and result steps share it.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object
+        user_id (str): Spotify user id
+        selected_playlists (list): List of ids for the selected playlists
+        snapshot_ids (list): List of snapshot ids for the selected playlists, if already known
+    
+    Returns:
+        dict: Mapping of artist ids, or keys derived from the artist's name for local tracks, to dicts with the
+            artist's name and the uris of their tracks, in the order they first appear in the selected playlists
+    """
+
+    if snapshot_ids is None:
+        snapshot_ids = get_snapshot_ids(spotify, user_id, selected_playlists)
+    key = "+".join(f"{playlist}:{snapshot_id}" for playlist, snapshot_id in zip(selected_playlists, snapshot_ids))
+    index = artist_index_cache.get(key)
+    if index is not None:
+        return index
+
+    track_lists = parallel_map(lambda args: get_playlist_tracks(spotify, user_id, *args), zip(selected_playlists, snapshot_ids))
+    index = {}
+    seen = set()
+    for tracks in track_lists:
+        for uri, _, artist_id, artist in tracks:
+            if uri in seen:
+                continue
+            seen.add(uri)
+
+            # Local tracks have no artist id, so their artist gets a key derived from the name, which can't contain
+            # the commas separating the selected artists
+            entry = index.setdefault(artist_id or _local_artist_key(artist), {"name": artist, "uris": []})
+            entry["uris"].append(uri)
+
+    artist_index_cache.set(key, index)
+    return index
+
+def _local_artist_key(name):
+    return "local-" + hashlib.sha1((name or "").encode("utf-8")).hexdigest()[:16]
+
+def get_playlist_info(spotify, user_id, playlist):
+    """Retrieves the name, current snapshot id and number of tracks of a playlist.
+
+    Requests only those fields, rather than the full playlist object with its first page of tracks.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object
+        user_id (str): Spotify user id
+        playlist (str): Id for the playlist
     
     Returns:
-        list: List of unique artists
+        dict: Dict with the playlist's name, snapshot_id and tracks total
     """
 
-    artists = []
-    for playlist in selected_playlists:
-        results = spotify.user_playlist_tracks(user_id, playlist)
-        tracks = results["items"]
-        while results["next"]:
-            results = spotify.next(results)
-            tracks.extend(results["items"])
-        
-        for track in tracks:
-            artists.append(track["track"]["artists"][0]["name"])
+    return call_with_retry(spotify.user_playlist, user_id, playlist, fields=FIELDS["playlist_info"], market=MARKET)
+
+def get_snapshot_ids(spotify, user_id, selected_playlists):
+    """Retrieves the current snapshot ids of the selected playlists.
+
+    Asks the API rather than the cached playlist listing, whose snapshot ids can be out of date, since the
+    snapshot ids are used as cache keys for the playlists' tracks.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object
+        user_id (str): Spotify user id
+        selected_playlists (list): List of ids for the selected playlists
+    
+    Returns:
+        list: List of snapshot ids, in the same order as selected_playlists
+    """
 
-    return list(set(artists))
+    infos = parallel_map(lambda playlist: get_playlist_info(spotify, user_id, playlist), selected_playlists)
+    return [info["snapshot_id"] for info in infos]
 
-def get_track_features(spotify, user_id, playlist):
-    """Retrieves all information about tracks in a playlist.
+def get_playlist_tracks(spotify, user_id, playlist, snapshot_id=None):
+    """Retrieves the tracks of a playlist, using the shared playlist cache and the track store.
 
-    Retrieves all information about tracks in a playlist, including the track"s audio features.
+    Looks up the playlist's current snapshot id and returns the cached or stored tracks for that snapshot if
+    there are any. Otherwise, fetches the playlist's pages concurrently, requesting only the fields that are
+    kept, and caches and stores the result, so an unchanged playlist is only downloaded once.
 
     Args:
         spotify (spotipy.Spotify): Spotify API object
         user_id (str): Spotify user id
         playlist (str): Id for the playlist
+        snapshot_id (str): Snapshot id for the playlist, if already known
     
     Returns:
-        pandas.DataFrame: DataFrame containing all track information
+        list: List of (uri, name, artist id, artist name) tuples in playlist order
     """
 
-    # Track info
-    results = spotify.user_playlist_tracks(user_id, playlist)
-    tracks = results["items"]
-    names, artists, uris = [], [], []
+    if snapshot_id is None:
+        snapshot_id = get_playlist_info(spotify, user_id, playlist)["snapshot_id"]
+    tracks = _cached_tracks(playlist, snapshot_id)
+    if tracks is not None:
+        return tracks
+
+    with stage("fetch_tracks"):
+        items = fetch_pages(_track_page_fetcher(spotify, user_id, playlist), 100)
+    tracks = _track_tuples(items)
 
-    while results["next"]:
-        results = spotify.next(results)
-        tracks.extend(results["items"])
+    _cache_tracks(playlist, snapshot_id, tracks)
+    return tracks
+
+def iter_playlist_tracks(spotify, user_id, playlist, snapshot_id, cache=True):
+    """Yields the tracks of a playlist as they are downloaded, using the shared playlist cache and track store.
+
+    Like get_playlist_tracks, but a playlist that has to be downloaded is yielded page by page, so callers
+    can start processing its first tracks before the last pages arrive.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object
+        user_id (str): Spotify user id
+        playlist (str): Id for the playlist
+        snapshot_id (str): Snapshot id for the playlist
+        cache (bool): Whether to keep the tracks in the in-process playlist cache, rather than only in the
+            track store
     
-    for track in tracks:
-        names.append(track["track"]["name"])
-        artists.append(track["track"]["artists"][0]["name"])
-        uris.append(track["track"]["uri"])
+    Yields:
+        tuple: (uri, name, artist id, artist name) of the next track in playlist order
+    """
 
-    # Audio features
-    offset = 0
-    all_features = []
-    acousticness, danceability, energy, instrumentalness, liveness, loudness, speechiness, valence = [], [], [], [], [], [], [], []
+    tracks = _cached_tracks(playlist, snapshot_id, cache)
+    if tracks is not None:
+        yield from tracks
+        return
+
+    # Only kept until the playlist is cached, so at most one playlist's tracks are held at once
+    tracks = []
+    for items in iter_pages(_track_page_fetcher(spotify, user_id, playlist), 100):
+        page = _track_tuples(items)
+        tracks.extend(page)
+        yield from page
+
+    _cache_tracks(playlist, snapshot_id, tracks, cache)
+
+def _cached_tracks(playlist, snapshot_id, cache=True):
+    key = f"{playlist}:{snapshot_id}"
+    tracks = playlist_cache.get(key)
+    if tracks is None and track_store is not None:
+        tracks = track_store.get_tracks(playlist, snapshot_id)
+        if tracks is not None and cache:
+            playlist_cache.set(key, tracks)
+
+    return tracks
+
+def _cache_tracks(playlist, snapshot_id, tracks, cache=True):
+    if cache:
+        playlist_cache.set(f"{playlist}:{snapshot_id}", tracks)
+    if track_store is not None:
+        track_store.set_tracks(playlist, snapshot_id, tracks)
+
+def _track_page_fetcher(spotify, user_id, playlist):
+    return lambda offset: spotify.user_playlist_tracks(user_id, playlist, fields=FIELDS["playlist_tracks"], limit=100, offset=offset, market=MARKET)
+
+def _track_tuples(items):
+    tracks = []
+    for item in items:
+        # Skip tracks that are no longer available
+        track = item["track"]
+        if track is None:
+            continue
+        artist = track["artists"][0]
+        tracks.append((track["uri"], track["name"], artist["id"], artist["name"]))
 
-    while offset < len(uris):
-        all_features += spotify.audio_features(uris[offset:offset+100])
-        offset += 100
+    return tracks
+
+def get_audio_features(spotify, uris, cache=True):
+    """Retrieves audio features for tracks, using the shared feature cache and the track store.
+
+    Only the tracks that have never been seen before are requested from the Spotify API, in batches of 100.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object
+        uris (list): List of track uris
+        cache (bool): Whether to keep the audio features in the in-process feature cache, rather than only in
+            the track store
     
-    for features in all_features:
-        acousticness.append(features["acousticness"])
-        danceability.append(features["danceability"])
-        energy.append(features["energy"])
-        instrumentalness.append(features["instrumentalness"])
-        liveness.append(features["liveness"])
-        loudness.append(features["loudness"])
-        speechiness.append(features["speechiness"])
-        valence.append(features["valence"])
-
-    # Combine everything
-    data = {
-            "name": names, 
-            "artist": artists, 
-            "uri": uris,
-            "acousticness": acousticness,
-            "danceability": danceability,
-            "energy": energy,
-            "instrumentalness": instrumentalness,
-            "liveness": liveness,
-            "loudness": loudness,
-            "speechiness": speechiness,
-            "valence": valence
-        }
+    Returns:
+        list: List of audio feature dicts, in the same order as uris, with None for tracks without any
+    """
+
+    cached = feature_cache.get_many(uris)
+    missing = list(dict.fromkeys(uri for uri in uris if uri not in cached))
+    if missing and track_store is not None:
+        stored = track_store.get_features(missing)
+        if cache:
+            feature_cache.set_many(stored)
+        cached.update(stored)
+        missing = [uri for uri in missing if uri not in stored]
+
+    offset = 0
+    with stage("audio_features"):
+        while offset < len(missing):
+            batch = missing[offset:offset+100]
+            fetched = {}
+            for uri, features in zip(batch, call_with_retry(spotify.audio_features, batch)):
+                fetched[uri] = {feature: features[feature] for feature in FEATURES} if features is not None else None
+            if cache:
+                feature_cache.set_many(fetched)
+            if track_store is not None:
+                track_store.set_features(fetched)
+            cached.update(fetched)
+            offset += 100
+
+    return [cached.get(uri) for uri in uris]
+
+def get_track_table(spotify, user_id, selected_playlists, snapshot_ids=None):
+    """Retrieves the unique tracks of the selected playlists as a single table.
+
+    Retrieves the tracks of every selected playlist concurrently and the audio features of each unique track,
+    then assembles them into one deduplicated table in a single pass.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object
+        user_id (str): Spotify user id
+        selected_playlists (list): List of ids for the selected playlists
+        snapshot_ids (list): List of snapshot ids for the selected playlists, if already known
     
-    df = pd.DataFrame(data)
-    return df
+    Returns:
+        pandas.DataFrame: DataFrame containing the track information, see track_table.build_track_table
+    """
+
+    snapshot_ids = snapshot_ids or [None] * len(selected_playlists)
+    track_lists = parallel_map(lambda args: get_playlist_tracks(spotify, user_id, *args), zip(selected_playlists, snapshot_ids))
+    uris = list(dict.fromkeys(track[0] for tracks in track_lists for track in tracks))
+    features = dict(zip(uris, get_audio_features(spotify, uris)))
+    return build_track_table(track_lists, features)
 
 def make_playlist(spotify, user_id, name, uris):
     """Creates a new playlist.
@@ -397,16 +689,9 @@ def make_playlist(spotify, user_id, name, uris):
         str: Id for the new playlist
     """
 
-    playlist_id = spotify.user_playlist_create(user_id, name, public=False)["id"]
-
-    offset = 0
-    while offset < len(uris):
-        spotify.user_playlist_add_tracks(user_id, playlist_id, uris[offset:offset+100])
-        offset += 100
+    return write_playlists(spotify, user_id, [{"name": name, "uris": uris}])[0]["id"]
 
-    return playlist_id
-
-def generate(option, spotify, user_id, selected_playlists):
+def generate(option, spotify, user_id, selected_playlists, **kwargs):
     """Generates a playlist or playlists based on the selected option.
 
     Calls the appropriate function based on the selected option for the user and their selected playlists,
@@ -417,6 +702,7 @@ def generate(option, spotify, user_id, selected_playlists):
         spotify (spotipy.Spotify): Spotify API object
         user_id (str): Spotify user id
         selected_playlists (list): List of ids for the selected playlists
+        **kwargs: Extra settings for the selected option, e.g. strategy for cluster
     
     Returns:
         list: List of id(s) for the generated playlist(s)
@@ -429,4 +715,30 @@ def generate(option, spotify, user_id, selected_playlists):
         "remove_duplicates": remove_duplicates
     }
 
-    return options[option](spotify, user_id, selected_playlists)
\ No newline at end of file
+    return options[option](spotify, user_id, selected_playlists, **kwargs)
+
+def iter_generate(option, spotify, user_id, selected_playlists, **kwargs):
+    """Generates a playlist or playlists based on the selected option, yielding each one as soon as it is ready.
+
+    Options that make several playlists yield each of them as soon as it has been written, so the first ones
+    can be shown while the rest are still being made. The other options yield their playlist once done.
+
+    Args:
+        option (str): Selected option
+        spotify (spotipy.Spotify): Spotify API object
+        user_id (str): Spotify user id
+        selected_playlists (list): List of ids for the selected playlists
+        **kwargs: Extra settings for the selected option, e.g. strategy for cluster
+
+    Yields:
+        str: Id for a generated playlist
+    """
+
+    options = {
+        "cluster": iter_cluster,
+        "recommend": recommend,
+        "merge": merge,
+        "remove_duplicates": remove_duplicates
+    }
+
+    yield from options[option](spotify, user_id, selected_playlists, **kwargs)
\ No newline at end of file
@@ -0,0 +1,19 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import lazy
+
+# Import the numeric stack in the master before forking, so workers share it copy-on-write instead of each
+# importing it on their first playlist generation. Off by default, which keeps the master small and boots
+# workers with only what the light pages need.
+PRELOAD = os.getenv("LAZIFY_PRELOAD", "0") == "1"
+
+# Threads per worker, so the result page's event streams don't hold up other requests
+threads = int(os.getenv("LAZIFY_WEB_THREADS", 8))
+
+def on_starting(server):
+    if PRELOAD:
+        lazy.preload()
+        server.log.info("Preloaded %s", ", ".join(lazy.HEAVY_MODULES))
@@ -0,0 +1,391 @@
+import os
+import re
+import json
+import time
+import cProfile
+import logging
+import threading
+import contextvars
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from spotipy.exceptions import SpotifyException
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Directory to dump a cProfile and a summary of every job to, if set
+PROFILE_DIR = os.getenv("LAZIFY_PROFILE_DIR")
+
+# Profile of the job being run, copied into the worker threads the job starts with in_current_context
+_profile = contextvars.ContextVar("lazify_profile", default=None)
+
+class Metrics:
+    """Process-wide registry of counters, gauges and histograms.
+
+    Metrics are identified by name and a dict of labels, and can be rendered in the Prometheus text
+    exposition format.
+    """
+
+    def __init__(self):
+        self._counters = defaultdict(float)
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels=None, value=1):
+        """Increments a counter.
+
+        Args:
+            name (str): Name of the counter
+            labels (dict): Labels for the counter
+            value (float): Amount to add
+
+        Returns:
+            None
+        """
+
+        with self._lock:
+            self._counters[(name, _label_key(labels))] += value
+
+    def set(self, name, labels=None, value=0):
+        """Sets a gauge.
+
+        Args:
+            name (str): Name of the gauge
+            labels (dict): Labels for the gauge
+            value (float): Value to set
+
+        Returns:
+            None
+        """
+
+        with self._lock:
+            self._gauges[(name, _label_key(labels))] = value
+
+    def observe(self, name, labels=None, value=0):
+        """Records an observation in a histogram.
+
+        Args:
+            name (str): Name of the histogram
+            labels (dict): Labels for the histogram
+            value (float): Observed value
+
+        Returns:
+            None
+        """
+
+        with self._lock:
+            histogram = self._histograms.setdefault((name, _label_key(labels)), [[0] * len(BUCKETS), 0, 0.0])
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def render(self):
+        """Renders every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics, one sample per line
+        """
+
+        lines = []
+        with self._lock:
+            for kind, samples in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted({name for name, _ in samples}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (sample_name, labels), value in sorted(samples.items()):
+                        if sample_name == name:
+                            lines.append(f"{name}{_format_labels(labels)} {value:g}")
+
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (sample_name, labels), (buckets, count, total) in sorted(self._histograms.items()):
+                    if sample_name != name:
+                        continue
+                    for bound, bucket in zip(BUCKETS, buckets):
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', f'{bound:g}'),))} {bucket}")
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {total:g}")
+
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def instrument(spotify):
+    """Records metrics for every call a Spotify API client makes.
+
+    Wraps the client so each call's endpoint, latency and status are recorded in the process-wide metrics and
+    in the profile of the job running the call, and installs a response hook recording response sizes and
+    JSON parse time.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object
+
+    Returns:
+        spotipy.Spotify: The same Spotify API object
+    """
+
+    internal_call = getattr(spotify, "_internal_call", None)
+    if internal_call is None or getattr(spotify, "_lazify_instrumented", False):
+        return spotify
+
+    def instrumented_call(method, url, payload, params):
+        endpoint = method + " " + endpoint_name(url)
+        status = "200"
+        start = time.perf_counter()
+        try:
+            return internal_call(method, url, payload, params)
+        except SpotifyException as e:
+            status = str(e.http_status)
+            raise
+        except Exception:
+            # Connection errors and timeouts, which spotipy doesn't wrap
+            status = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.inc("lazify_api_calls_total", {"endpoint": endpoint, "status": status})
+            metrics.observe("lazify_api_call_seconds", {"endpoint": endpoint}, elapsed)
+            profile = getattr(spotify, "_lazify_profile", None)
+            if profile is not None:
+                profile.add_call(endpoint, status, elapsed)
+
+    spotify._internal_call = instrumented_call
+    spotify._lazify_instrumented = True
+    track_payloads(spotify)
+
+    return spotify
+
+def track_payloads(spotify):
+    """Records the size and parse time of every response a Spotify API client receives.
+
+    Installs a response hook on the client's HTTP session. The counters are kept per endpoint and can be read
+    with payload_stats.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object
+
+    Returns:
+        spotipy.Spotify: The same Spotify API object
+    """
+
+    hooks = getattr(getattr(spotify, "_session", None), "hooks", None)
+    if hooks is not None and _record_payload not in hooks["response"]:
+        hooks["response"].append(_record_payload)
+
+    return spotify
+
+def payload_stats():
+    """Returns the response size and parse time counters.
+
+    Returns:
+        dict: Mapping of endpoints, e.g. "GET playlists/{id}/tracks", to their number of responses, bytes
+            received and seconds spent parsing JSON
+    """
+
+    with metrics._lock:
+        counters = list(metrics._counters.items())
+
+    stats = defaultdict(lambda: {"responses": 0, "bytes": 0, "parse_seconds": 0.0})
+    for (name, labels), value in counters:
+        field = {
+            "lazify_api_responses_total": "responses",
+            "lazify_api_response_bytes_total": "bytes",
+            "lazify_api_parse_seconds_total": "parse_seconds"
+        }.get(name)
+        if field is not None:
+            stats[dict(labels)["endpoint"]][field] = value
+
+    return dict(stats)
+
+def endpoint_name(url):
+    """Returns a URL's Spotify API endpoint with ids replaced by placeholders.
+
+    Args:
+        url (str): Request URL
+
+    Returns:
+        str: Endpoint, e.g. "playlists/{id}/tracks"
+    """
+
+    path = urlsplit(url).path.split("/v1/", 1)[-1].lstrip("/")
+    path = re.sub(r"(users|playlists|tracks|artists|albums)/[^/]+", r"\1/{id}", path)
+    return path.rstrip("/")
+
+@contextmanager
+def stage(name):
+    """Times a stage of playlist generation.
+
+    Records the stage's wall time and the CPU time of the calling thread in the process-wide metrics and in the
+    profile of the job running in the calling thread, if any. The CPU time is the calling thread's only, so
+    stages that hand their work to thread pools or worker processes, such as fetch_tracks, playlist_writes
+    and k_sweep, report little CPU time however much work the pool does.
+
+    Args:
+        name (str): Name of the stage, e.g. "fetch_tracks" or "kmeans"
+
+    Yields:
+        None
+    """
+
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        cpu = time.thread_time() - cpu_start
+        metrics.observe("lazify_stage_seconds", {"stage": name}, elapsed)
+        metrics.inc("lazify_stage_cpu_seconds_total", {"stage": name}, cpu)
+        profile = _profile.get()
+        if profile is not None:
+            profile.add_stage(name, elapsed, cpu)
+
+def count_retry(status):
+    """Records a retried Spotify API call.
+
+    Args:
+        status (int): HTTP status of the failed attempt
+
+    Returns:
+        None
+    """
+
+    metrics.inc("lazify_api_retries_total", {"status": str(status)})
+    profile = _profile.get()
+    if profile is not None:
+        profile.add_retry()
+
+class JobProfile:
+    """Timing breakdown of a single job.
+
+    Collects the stages and API calls of a job, to be logged as a structured summary once it finishes.
+
+    Args:
+        job_id (str): Id for the job
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.stages = defaultdict(lambda: {"count": 0, "seconds": 0.0, "cpu_seconds": 0.0})
+        self.calls = defaultdict(lambda: {"count": 0, "errors": 0, "seconds": 0.0})
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, elapsed, cpu):
+        with self._lock:
+            self.stages[name]["count"] += 1
+            self.stages[name]["seconds"] += elapsed
+            self.stages[name]["cpu_seconds"] += cpu
+
+    def add_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def add_call(self, endpoint, status, elapsed):
+        with self._lock:
+            self.calls[endpoint]["count"] += 1
+            self.calls[endpoint]["errors"] += status != "200"
+            self.calls[endpoint]["seconds"] += elapsed
+
+    def summary(self):
+        """Returns the job's timing breakdown.
+
+        Returns:
+            dict: The job id, retries, and the count and time of each stage and API endpoint
+        """
+
+        with self._lock:
+            return {
+                "job_id": self.job_id,
+                "retries": self.retries,
+                "stages": {name: dict(stats) for name, stats in self.stages.items()},
+                "api_calls": {endpoint: dict(stats) for endpoint, stats in self.calls.items()}
+            }
+
+@contextmanager
+def profile_job(job_id, spotify=None):
+    """Collects the timing breakdown of a job running in the calling thread.
+
+    Stages and retries are attributed to the job in the calling thread and in any thread running a function
+    wrapped with in_current_context. Logs the breakdown as a single JSON line when the job finishes and, if
+    LAZIFY_PROFILE_DIR is set, also dumps a cProfile of the job and the breakdown to that directory.
+
+    Args:
+        job_id (str): Id for the job
+        spotify (spotipy.Spotify): The job's Spotify API object, whose calls are attributed to the job
+
+    Yields:
+        JobProfile: The job's profile
+    """
+
+    profile = JobProfile(job_id)
+    token = _profile.set(profile)
+    if spotify is not None:
+        spotify._lazify_profile = profile
+    profiler = cProfile.Profile() if PROFILE_DIR else None
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        yield profile
+    finally:
+        _profile.reset(token)
+        if spotify is not None:
+            spotify._lazify_profile = None
+        summary = profile.summary()
+        logger.info(json.dumps({"event": "job_profile", **summary}))
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(os.path.join(PROFILE_DIR, f"{job_id}.prof"))
+            with open(os.path.join(PROFILE_DIR, f"{job_id}.json"), "w") as f:
+                json.dump(summary, f, indent=4)
+
+def in_current_context(function):
+    """Wraps a function to run in the calling thread's context wherever it is called.
+
+    Used for functions handed to thread pools and threads, so the stages and retries they record count towards
+    the profile of the job that started them.
+
+    Args:
+        function (callable): Function to wrap
+
+    Returns:
+        callable: Function calling function in a copy of the calling thread's context
+    """
+
+    context = contextvars.copy_context()
+    # Each call gets its own copy, since a context can only be entered by one thread at a time
+    return lambda *args, **kwargs: context.copy().run(function, *args, **kwargs)
+
+def _record_payload(response, *args, **kwargs):
+    labels = {"endpoint": response.request.method + " " + endpoint_name(response.url)}
+    metrics.inc("lazify_api_responses_total", labels)
+    metrics.inc("lazify_api_response_bytes_total", labels, len(response.content))
+
+    # Time the JSON parsing spotipy does after the hook returns
+    parse = response.json
+    def timed_json(**kwargs):
+        start = time.perf_counter()
+        try:
+            return parse(**kwargs)
+        finally:
+            metrics.inc("lazify_api_parse_seconds_total", labels, time.perf_counter() - start)
+    response.json = timed_json
+
+    return response
+
+def _label_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
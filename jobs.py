@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import profile_job
+
+logger = logging.getLogger(__name__)
+
+# Limits for background jobs, overridable through the environment
+MAX_WORKERS = int(os.getenv("LAZIFY_JOB_WORKERS", 4))
+MAX_PER_USER = int(os.getenv("LAZIFY_JOBS_PER_USER", 1))
+MAX_QUEUED = int(os.getenv("LAZIFY_JOB_QUEUE_SIZE", 32))
+# Path to the job store's database file, overridable through the environment; empty to keep jobs in memory, which
+# only suits a single worker process
+STORE_PATH = os.getenv("LAZIFY_JOB_STORE", "lazify_jobs.db")
+# Seconds finished jobs are kept, and seconds without an update after which an active job is taken to have died
+# with its process, overridable through the environment
+JOB_TTL = float(os.getenv("LAZIFY_JOB_TTL", 24 * 60 * 60))
+STALE_AFTER = float(os.getenv("LAZIFY_JOB_TIMEOUT", 60 * 60))
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+ACTIVE = (QUEUED, RUNNING)
+INTERRUPTED = "Lazify was interrupted while generating your playlists, please try again"
+
+_current = threading.local()
+
+class JobLimitError(Exception):
+    """Raised when a job can't be queued because a concurrency limit has been reached."""
+
+class MemoryJobStore:
+    """Keeps job records in memory.
+
+    Only visible to the process that created the jobs, so it suits a single worker or local development.
+
+    Every store also has prune(), which fails active jobs that haven't been updated for stale_after seconds,
+    since their process has most likely died, and deletes jobs that finished more than ttl seconds ago.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job):
+        with self._lock:
+            self._jobs[job["id"]] = dict(job)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields, updated_at=time.time())
+
+    def count_active(self, user_id=None):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job["status"] in ACTIVE and user_id in (None, job["user_id"]))
+
+    def prune(self, ttl=JOB_TTL, stale_after=STALE_AFTER):
+        now = time.time()
+        with self._lock:
+            for job_id, job in list(self._jobs.items()):
+                if job["status"] in ACTIVE and job["updated_at"] < now - stale_after:
+                    job.update(status=FAILED, error=INTERRUPTED, finished_at=now, updated_at=now)
+                elif job["status"] not in ACTIVE and job["updated_at"] < now - ttl:
+                    del self._jobs[job_id]
+
+class SQLiteJobStore:
+    """Keeps job records in a SQLite database.
+
+    Shared by every process using the same database file, so any gunicorn worker can report the progress of a
+    job running in another.
+
+    Args:
+        path (str): Path to the SQLite database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, user_id TEXT, status TEXT, data TEXT, updated_at REAL)"
+            )
+            # Databases created before jobs were pruned lack the update time
+            if "updated_at" not in [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]:
+                conn.execute("ALTER TABLE jobs ADD COLUMN updated_at REAL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated_at)")
+
+    def create(self, job):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs VALUES (?, ?, ?, ?, ?)",
+                (job["id"], job["user_id"], job["status"], json.dumps(job), job["updated_at"])
+            )
+
+    def get(self, job_id):
+        row = self._connect().execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def update(self, job_id, **fields):
+        with self._connect() as conn:
+            job = json.loads(conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()[0])
+            job.update(fields, updated_at=time.time())
+            conn.execute(
+                "UPDATE jobs SET status = ?, data = ?, updated_at = ? WHERE id = ?",
+                (job["status"], json.dumps(job), job["updated_at"], job_id)
+            )
+
+    def count_active(self, user_id=None):
+        query = "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)"
+        params = list(ACTIVE)
+        if user_id is not None:
+            query += " AND user_id = ?"
+            params.append(user_id)
+        return self._connect().execute(query, params).fetchone()[0]
+
+    def prune(self, ttl=JOB_TTL, stale_after=STALE_AFTER):
+        now = time.time()
+        conn = self._connect()
+        stale = conn.execute(
+            "SELECT id FROM jobs WHERE status IN (?, ?) AND updated_at < ?", (*ACTIVE, now - stale_after)
+        ).fetchall()
+        for (job_id,) in stale:
+            self.update(job_id, status=FAILED, error=INTERRUPTED, finished_at=now)
+        with conn:
+            conn.execute("DELETE FROM jobs WHERE status NOT IN (?, ?) AND updated_at < ?", (*ACTIVE, now - ttl))
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+
+        return conn
+
+class JobQueue:
+    """Runs playlist generation jobs in the background.
+
+    Jobs run on a bounded thread pool, so a request can queue a job and return immediately while its progress
+    is tracked in the job store. Playlist ids yielded by a job are recorded as they come, so they can be shown
+    before the job finishes. The number of active jobs is limited overall and per user. Old and abandoned jobs
+    are pruned from the store whenever a job is queued, so jobs lost with a dead process don't count against
+    the limits forever.
+
+    Args:
+        store (MemoryJobStore or SQLiteJobStore): Where job records are kept
+        max_workers (int): Maximum number of jobs running at once
+        max_per_user (int): Maximum number of queued or running jobs per user
+        max_queued (int): Maximum number of queued or running jobs overall
+    """
+
+    def __init__(self, store, max_workers=MAX_WORKERS, max_per_user=MAX_PER_USER, max_queued=MAX_QUEUED):
+        self.store = store
+        self.max_per_user = max_per_user
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+
+    def submit(self, user_id, function, *args, **kwargs):
+        """Queues a job.
+
+        Args:
+            user_id (str): Spotify user id of the job's owner
+            function (callable): Function to run, returning or yielding playlist ids
+            *args: Positional arguments for the function
+            **kwargs: Keyword arguments for the function
+
+        Returns:
+            str: Id for the new job
+
+        Raises:
+            JobLimitError: If the user or the server already has too many active jobs
+        """
+
+        with self._lock:
+            self.store.prune()
+            if self.store.count_active(user_id) >= self.max_per_user:
+                raise JobLimitError("You already have a playlist being generated, please wait for it to finish")
+            if self.store.count_active() >= self.max_queued:
+                raise JobLimitError("Lazify is busy right now, please try again in a minute")
+
+            job = {
+                "id": uuid.uuid4().hex,
+                "user_id": user_id,
+                "status": QUEUED,
+                "progress": "Waiting to start",
+                "result": None,
+                "error": None,
+                "created_at": time.time(),
+                "updated_at": time.time(),
+                "started_at": None,
+                "finished_at": None
+            }
+            self.store.create(job)
+
+        self._executor.submit(self._run, job["id"], function, args, kwargs)
+        return job["id"]
+
+    def get(self, job_id):
+        """Retrieves a job's record.
+
+        Args:
+            job_id (str): Id for the job
+
+        Returns:
+            dict: The job's record, or None if there is no such job
+        """
+
+        return self.store.get(job_id)
+
+    def _run(self, job_id, function, args, kwargs):
+        _current.job_id = job_id
+        _current.store = self.store
+        self.store.update(job_id, status=RUNNING, progress="Starting", started_at=time.time())
+
+        # Attribute the calls of an instrumented Spotify API object passed to the job to its profile
+        spotify = next((arg for arg in args if getattr(arg, "_lazify_instrumented", False)), None)
+        try:
+            result = []
+            with profile_job(job_id, spotify):
+                for playlist_id in function(*args, **kwargs):
+                    result.append(playlist_id)
+                    self.store.update(job_id, result=list(result))
+            self.store.update(job_id, status=DONE, progress="Done", result=result, finished_at=time.time())
+        except Exception as e:
+            logger.exception("Job %s failed", job_id)
+            self.store.update(job_id, status=FAILED, error=str(e), finished_at=time.time())
+        finally:
+            _current.job_id = None
+
+def report_progress(message):
+    """Records the progress of the job running in the current thread.
+
+    Does nothing outside of a job, so generation code can report progress unconditionally.
+
+    Args:
+        message (str): Description of the current step
+
+    Returns:
+        None
+    """
+
+    job_id = getattr(_current, "job_id", None)
+    if job_id is not None:
+        _current.store.update(job_id, progress=message)
+
+def create_queue():
+    """Creates a job queue using the store configured in the environment.
+
+    Uses a SQLiteJobStore at LAZIFY_JOB_STORE, so any gunicorn worker can report on a job queued in another,
+    or a MemoryJobStore if LAZIFY_JOB_STORE is set to an empty string, for a single worker process.
+
+    Returns:
+        JobQueue: The new job queue
+    """
+
+    store = SQLiteJobStore(STORE_PATH) if STORE_PATH else MemoryJobStore()
+    return JobQueue(store)
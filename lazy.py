@@ -0,0 +1,77 @@
+import os
+import sys
+import importlib
+from types import ModuleType
+
+# Whether heavy modules are imported on first use rather than at startup, overridable through the environment
+ENABLED = os.getenv("LAZIFY_LAZY_IMPORTS", "1") != "0"
+
+# The numeric stack, which only playlist generation needs
+HEAVY_MODULES = [
+    "numpy",
+    "pandas",
+    "joblib",
+    "sklearn.cluster",
+    "sklearn.decomposition",
+    "sklearn.metrics",
+    "sklearn.neighbors",
+    "sklearn.preprocessing"
+]
+
+class LazyModule(ModuleType):
+    """Stand-in for a module that imports it on first attribute access.
+
+    Attributes are looked up on the real module once and then kept on the stand-in, so using a lazily imported
+    module costs the same as using the module itself after the first access.
+
+    Args:
+        name (str): Fully qualified name of the module
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+
+    def __getattr__(self, attr):
+        value = getattr(importlib.import_module(self.__name__), attr)
+        setattr(self, attr, value)
+        return value
+
+    def __reduce__(self):
+        # Pickle as a reference to the real module, e.g. in functions sent to joblib workers
+        return importlib.import_module, (self.__name__,)
+
+    def __repr__(self):
+        loaded = "loaded" if self.__name__ in sys.modules else "not loaded"
+        return f"<lazy module '{self.__name__}' ({loaded})>"
+
+def lazy_import(name):
+    """Imports a module on first use.
+
+    Args:
+        name (str): Fully qualified name of the module
+
+    Returns:
+        module: The module itself if it is already imported or lazy imports are disabled with
+            LAZIFY_LAZY_IMPORTS=0, otherwise a LazyModule standing in for it
+    """
+
+    if not ENABLED or name in sys.modules:
+        return importlib.import_module(name)
+
+    return LazyModule(name)
+
+def preload(modules=HEAVY_MODULES):
+    """Imports the heavy modules now.
+
+    Called in the gunicorn master before workers are forked, so the workers share the imported modules
+    copy-on-write instead of each importing them again.
+
+    Args:
+        modules (list): Names of the modules to import
+
+    Returns:
+        None
+    """
+
+    for name in modules:
+        importlib.import_module(name)
@@ -0,0 +1,216 @@
+import os
+import time
+import logging
+from collections import namedtuple
+
+from threadpoolctl import threadpool_limits
+from instrumentation import stage
+from jobs import MAX_WORKERS as JOB_WORKERS
+from lazy import lazy_import
+
+np = lazy_import("numpy")
+joblib = lazy_import("joblib")
+cluster = lazy_import("sklearn.cluster")
+metrics = lazy_import("sklearn.metrics")
+
+logger = logging.getLogger(__name__)
+
+# Defaults for the k sweep, overridable through the environment
+STRATEGY = os.getenv("LAZIFY_CLUSTER_STRATEGY", "sampled")
+K_MIN = 2
+K_MAX = 20
+SAMPLE_SIZE = int(os.getenv("LAZIFY_SILHOUETTE_SAMPLE_SIZE", 2000))
+RANDOM_STATE = 1738
+
+# Cores one clustering job may use, by default an equal share of the cores for each of the LAZIFY_JOB_WORKERS
+# jobs that can run at once, and the joblib backend the k sweep runs on
+CPU_BUDGET = int(os.getenv("LAZIFY_CPU_BUDGET", 0)) or max(1, (os.cpu_count() or 1) // max(JOB_WORKERS, 1))
+BACKEND = os.getenv("LAZIFY_CLUSTER_BACKEND", "loky")
+# Smallest selection worth starting workers for
+PARALLEL_MIN_TRACKS = int(os.getenv("LAZIFY_PARALLEL_MIN_TRACKS", 2000))
+
+# Result of a k sweep: the chosen k, the labels for it, the score for each k tried, the strategy and the time
+# spent in seconds
+Selection = namedtuple("Selection", ["k", "labels", "scores", "strategy", "elapsed"])
+
+def select_k(X, strategy=None, k_min=K_MIN, k_max=K_MAX, sample_size=SAMPLE_SIZE, patience=None, random_state=RANDOM_STATE, n_jobs=None):
+    """Chooses the number of clusters for K-means and clusters the data.
+
+    Sweeps k from k_min to k_max with the given strategy and returns the labels for the best k, so the
+    caller doesn't need to fit the final model again. Available strategies:
+
+        exhaustive: KMeans and exact silhouette score for every k (the original behaviour, O(n^2) per k)
+        sampled: KMeans and silhouette score on a random sample of at most sample_size tracks
+        minibatch: MiniBatchKMeans and sampled silhouette score
+        warm: KMeans warm-started from the previous k's centers plus one new center, sampled silhouette score
+        elbow: the elbow of the KMeans inertia curve, no silhouette score at all
+
+    For large selections, the exhaustive, sampled and minibatch strategies fit and score several values of k
+    at once, one per core, while the warm and elbow strategies go through k in order. Either way, the BLAS and
+    OpenMP threads of the sweep are limited so the whole job stays within n_jobs cores. The budget is per job:
+    by default each of the LAZIFY_JOB_WORKERS jobs that can run at once gets an equal share of the cores, so
+    concurrent jobs don't oversubscribe the machine. Deployments with several gunicorn workers should lower
+    LAZIFY_CPU_BUDGET accordingly. The loky backend's worker processes are reused by later sweeps and exit once
+    idle for a few minutes; LAZIFY_CLUSTER_BACKEND=threading keeps the sweep in the job's own process.
+
+    Args:
+        X (numpy.ndarray): Data to cluster, of shape (number of tracks, number of features)
+        strategy (str): Name of the strategy, defaults to LAZIFY_CLUSTER_STRATEGY or "sampled"
+        k_min (int): Smallest number of clusters to try
+        k_max (int): Largest number of clusters to try
+        sample_size (int): Number of tracks to compute silhouette scores on
+        patience (int): Stop the sweep once the score hasn't improved for this many values of k, or None to
+            always try every k
+        random_state (int): Seed for K-means and sampling
+        n_jobs (int): Number of cores this job may use, defaults to LAZIFY_CPU_BUDGET or an equal share of the
+            cores per concurrent job
+
+    Returns:
+        Selection: The chosen k, its labels, the score for each k tried, the strategy and the time spent
+    """
+
+    strategy = strategy or STRATEGY
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown clustering strategy: {strategy}")
+
+    start = time.perf_counter()
+    n = len(X)
+
+    # Silhouette score needs 2 <= k <= n - 1
+    k_max = min(k_max, n - 1)
+    if k_max < k_min:
+        return Selection(1, np.zeros(n, dtype=int), {}, strategy, time.perf_counter() - start)
+
+    n_jobs = n_jobs or CPU_BUDGET
+    with threadpool_limits(limits=n_jobs):
+        k, labels, scores = STRATEGIES[strategy](X, k_min, k_max, sample_size, patience, random_state, n_jobs)
+    elapsed = time.perf_counter() - start
+    logger.info(
+        "Chose k=%d for %d tracks with %s strategy in %.2f s on %d cores (tried %d values of k)",
+        k, n, strategy, elapsed, n_jobs, len(scores)
+    )
+
+    return Selection(k, labels, scores, strategy, elapsed)
+
+def _silhouette_sweep(fit, X, k_min, k_max, sample_size, patience, random_state, n_jobs=1):
+    best_k, best_labels, best_score = None, None, -np.inf
+    scores = {}
+    since_best = 0
+    sample_size = sample_size if sample_size and sample_size < len(X) else None
+
+    ks = range(k_min, k_max + 1)
+    if n_jobs > 1 and len(ks) > 1 and len(X) >= PARALLEL_MIN_TRACKS:
+        results = _parallel_scores(fit, X, ks, sample_size, random_state, n_jobs)
+    else:
+        results = _serial_scores(fit, X, ks, sample_size, random_state)
+
+    # Results come in order of k, so stopping early picks the same k whether or not the sweep is parallel
+    for k, labels, score in results:
+        scores[k] = score
+        if scores[k] > best_score:
+            best_k, best_labels, best_score = k, labels, scores[k]
+            since_best = 0
+        else:
+            since_best += 1
+            if patience is not None and since_best >= patience:
+                break
+
+    return best_k, best_labels, scores
+
+def _serial_scores(fit, X, ks, sample_size, random_state):
+    for k in ks:
+        with stage("kmeans"):
+            labels = fit(k)
+        with stage("silhouette"):
+            score = metrics.silhouette_score(X, labels, sample_size=sample_size, random_state=random_state)
+        yield k, labels, score
+
+def _parallel_scores(fit, X, ks, sample_size, random_state, n_jobs):
+    # One k per worker, with the budget's remaining cores split between the workers' BLAS and OpenMP threads.
+    # ks are submitted one batch at a time, so an early stop doesn't leave the rest of the sweep running.
+    n_workers = min(n_jobs, len(ks))
+    threads = max(1, n_jobs // n_workers)
+    with threadpool_limits(limits=threads), joblib.Parallel(n_jobs=n_workers, backend=BACKEND) as parallel:
+        for offset in range(0, len(ks), n_workers):
+            batch = ks[offset:offset+n_workers]
+            with stage("k_sweep"):
+                results = parallel(joblib.delayed(_fit_and_score)(fit, X, k, sample_size, random_state, threads) for k in batch)
+            for k, (labels, score) in zip(batch, results):
+                yield k, labels, score
+
+def _fit_and_score(fit, X, k, sample_size, random_state, threads):
+    # Worker processes don't inherit the parent's thread limits
+    with threadpool_limits(limits=threads):
+        labels = fit(k)
+        return labels, metrics.silhouette_score(X, labels, sample_size=sample_size, random_state=random_state)
+
+def _exhaustive(X, k_min, k_max, sample_size, patience, random_state, n_jobs=1):
+    fit = lambda k: cluster.KMeans(n_clusters=k, init="k-means++", n_init=10, random_state=random_state).fit_predict(X)
+    return _silhouette_sweep(fit, X, k_min, k_max, None, patience, random_state, n_jobs)
+
+def _sampled(X, k_min, k_max, sample_size, patience, random_state, n_jobs=1):
+    fit = lambda k: cluster.KMeans(n_clusters=k, init="k-means++", n_init=10, random_state=random_state).fit_predict(X)
+    return _silhouette_sweep(fit, X, k_min, k_max, sample_size, patience, random_state, n_jobs)
+
+def _minibatch(X, k_min, k_max, sample_size, patience, random_state, n_jobs=1):
+    fit = lambda k: cluster.MiniBatchKMeans(n_clusters=k, init="k-means++", n_init=3, batch_size=1024, random_state=random_state).fit_predict(X)
+    return _silhouette_sweep(fit, X, k_min, k_max, sample_size, patience, random_state, n_jobs)
+
+def _warm(X, k_min, k_max, sample_size, patience, random_state, n_jobs=1):
+    rng = np.random.RandomState(random_state)
+    centers = None
+
+    def fit(k):
+        nonlocal centers
+        if centers is None:
+            model = cluster.KMeans(n_clusters=k, init="k-means++", n_init=10, random_state=random_state)
+        else:
+            # Add one center, chosen k-means++ style from the points far from the current centers
+            distances = ((X[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).min(axis=1)
+            new_center = X[rng.choice(len(X), p=distances / distances.sum())] if distances.sum() > 0 else X[rng.randint(len(X))]
+            model = cluster.KMeans(n_clusters=k, init=np.vstack([centers, new_center]), n_init=1, random_state=random_state)
+
+        labels = model.fit_predict(X)
+        centers = model.cluster_centers_
+        return labels
+
+    # Each k starts from the previous k's centers, so this sweep can't be spread across workers
+    return _silhouette_sweep(fit, X, k_min, k_max, sample_size, patience, random_state)
+
+def _elbow(X, k_min, k_max, sample_size, patience, random_state, n_jobs=1, tolerance=0.02):
+    inertias, all_labels = {}, {}
+    flat = 0
+    for k in range(k_min, k_max + 1):
+        model = cluster.KMeans(n_clusters=k, init="k-means++", n_init=3, random_state=random_state)
+        with stage("kmeans"):
+            all_labels[k] = model.fit_predict(X)
+        inertias[k] = model.inertia_
+
+        # Stop early once adding clusters barely reduces the inertia
+        previous = inertias.get(k - 1)
+        if previous and (previous - inertias[k]) / previous < tolerance:
+            flat += 1
+            if flat >= (patience or 2):
+                break
+        else:
+            flat = 0
+
+    # Elbow is the point furthest below the line joining the ends of the normalized inertia curve
+    ks = np.array(list(inertias))
+    values = np.array(list(inertias.values()))
+    if len(ks) < 3 or values[0] == values[-1]:
+        best_k = ks[0]
+    else:
+        x = (ks - ks[0]) / (ks[-1] - ks[0])
+        y = (values - values[-1]) / (values[0] - values[-1])
+        best_k = ks[np.argmax(1 - x - y)]
+
+    return int(best_k), all_labels[best_k], inertias
+
+STRATEGIES = {
+    "exhaustive": _exhaustive,
+    "sampled": _sampled,
+    "minibatch": _minibatch,
+    "warm": _warm,
+    "elbow": _elbow
+}
@@ -0,0 +1,270 @@
+import os
+import hashlib
+import logging
+import tempfile
+from cache import model_cache
+from instrumentation import stage
+from lazy import lazy_import
+from model_selection import RANDOM_STATE, STRATEGY, select_k
+from track_table import FEATURES, feature_matrix
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+cluster = lazy_import("sklearn.cluster")
+decomposition = lazy_import("sklearn.decomposition")
+preprocessing = lazy_import("sklearn.preprocessing")
+
+logger = logging.getLogger(__name__)
+
+# Selections of at least this many tracks are clustered out of core, in chunks of CHUNK_SIZE tracks, with their
+# features buffered in BUFFER_DIR (the system's temporary directory by default), overridable through the
+# environment
+STREAMING_THRESHOLD = int(os.getenv("LAZIFY_STREAMING_THRESHOLD", 100000))
+CHUNK_SIZE = int(os.getenv("LAZIFY_STREAMING_CHUNK_SIZE", 10000))
+BUFFER_DIR = os.getenv("LAZIFY_BUFFER_DIR") or None
+# Number of tracks the number of clusters is chosen on, and passes over the buffer to fit the final clusters
+STREAMING_SAMPLE_SIZE = 20000
+STREAMING_EPOCHS = 3
+
+def selection_key(uris):
+    """Returns a key identifying a set of tracks.
+
+    The key only depends on which tracks are in the set, not on their order or on which playlists they came
+    from, so the same tracks selected again, or through different playlists, share their fitted models.
+
+    Args:
+        uris (iterable): Track uris
+
+    Returns:
+        str: Hex digest of the audio features used and the sorted, unique uris
+    """
+
+    digest = hashlib.sha1(",".join(FEATURES).encode())
+    for uri in sorted(set(uris)):
+        digest.update(uri.encode())
+        digest.update(b"\n")
+
+    return digest.hexdigest()
+
+def scale_features(data, key=None):
+    """Scales the audio features of a track table to [0, 1], using the shared model cache.
+
+    Args:
+        data (pandas.DataFrame): Track table from track_table.build_track_table
+        key (str): Selection key for the table's tracks, computed if not given
+
+    Returns:
+        tuple: The fitted sklearn.preprocessing.MinMaxScaler and the scaled float32 feature matrix, in the same
+            row order as data
+    """
+
+    key = key or selection_key(data["uri"])
+    entry = model_cache.get(f"{key}:scaled")
+    if entry is None:
+        scaler = preprocessing.MinMaxScaler()
+        scaled = scaler.fit_transform(feature_matrix(data)).astype(np.float32, copy=False)
+        entry = {"uris": _uris(data), "scaler": scaler, "scaled": scaled}
+        model_cache.set(f"{key}:scaled", entry)
+    else:
+        logger.info("Reusing scaled features for %d tracks", len(data))
+
+    return entry["scaler"], _align(entry, data, entry["scaled"])
+
+def cluster_tracks(data, strategy=None, k_max=20, key=None):
+    """Clusters the tracks of a track table by audio features, using the shared model cache.
+
+    Scales the features, reduces them with PCA and clusters them with K-means, choosing the number of clusters
+    with model_selection.select_k. The fitted PCA, the chosen k and the labels are cached for the set of tracks,
+    so clustering the same tracks again skips all of the numeric work.
+
+    Args:
+        data (pandas.DataFrame): Track table from track_table.build_track_table
+        strategy (str): Strategy for choosing the number of clusters, see model_selection.select_k
+        k_max (int): Largest number of clusters to try
+        key (str): Selection key for the table's tracks, computed if not given
+
+    Returns:
+        tuple: The number of clusters and the cluster label of each track, in the same row order as data
+    """
+
+    key = key or selection_key(data["uri"])
+    cache_key = f"{key}:clusters:{strategy or STRATEGY}:{k_max}"
+    entry = model_cache.get(cache_key)
+    if entry is None:
+        _, scaled = scale_features(data, key)
+
+        # Arbitrarily chose 0.8 as cutoff for explained variance
+        with stage("pca"):
+            pca = decomposition.PCA(n_components=0.8)
+            reduced = pca.fit_transform(scaled)
+
+        selection = select_k(reduced, strategy=strategy, k_max=k_max)
+        entry = {
+            "uris": _uris(data),
+            "pca": pca,
+            "k": selection.k,
+            "labels": selection.labels,
+            "scores": selection.scores
+        }
+        model_cache.set(cache_key, entry)
+    else:
+        logger.info("Reusing clustering of %d tracks into %d clusters", len(data), entry["k"])
+
+    return entry["k"], _align(entry, data, entry["labels"])
+
+def _uris(data):
+    return data["uri"].astype(object).to_numpy()
+
+def _align(entry, data, values):
+    # The cached rows may be in a different order if the same tracks were selected in a different order
+    uris = _uris(data)
+    if len(uris) == len(entry["uris"]) and np.array_equal(uris, entry["uris"]):
+        return values
+
+    return values[pd.Index(entry["uris"]).get_indexer(uris)]
+
+class FeatureBuffer:
+    """Float32 matrix of audio features kept in a memory-mapped temporary file.
+
+    Rows are appended chunk by chunk as tracks are fetched and read back chunk by chunk, so the features of a
+    selection of any size never need to fit in memory at once. The file grows as needed and is deleted when
+    the buffer is closed.
+
+    Args:
+        capacity (int): Expected number of rows, e.g. the total number of tracks in the selected playlists
+        directory (str): Directory for the temporary file, the system's temporary directory by default
+    """
+
+    def __init__(self, capacity, directory=BUFFER_DIR):
+        self._file = tempfile.NamedTemporaryFile(prefix="lazify-features-", suffix=".f32", dir=directory)
+        self._matrix = None
+        self.capacity = 0
+        self.size = 0
+        self._resize(max(capacity, 1))
+
+    def append(self, rows):
+        """Appends rows of audio features.
+
+        Args:
+            rows (numpy.ndarray): Array of shape (number of tracks, number of audio features)
+
+        Returns:
+            None
+        """
+
+        if self.size + len(rows) > self.capacity:
+            self._resize(max(self.size + len(rows), 2 * self.capacity))
+        self._matrix[self.size:self.size+len(rows)] = rows
+        self.size += len(rows)
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        """Yields the rows in order, a chunk at a time.
+
+        Args:
+            chunk_size (int): Number of rows per chunk
+
+        Yields:
+            numpy.ndarray: Read-only view of the next chunk of rows
+        """
+
+        for offset in range(0, self.size, chunk_size):
+            yield self._matrix[offset:min(offset+chunk_size, self.size)]
+
+    def take(self, indices):
+        """Returns the rows at the given indices.
+
+        Args:
+            indices (numpy.ndarray): Sorted row indices
+
+        Returns:
+            numpy.ndarray: Array of the selected rows, in memory
+        """
+
+        return np.asarray(self._matrix[indices])
+
+    def close(self):
+        """Releases the memory map and deletes the file."""
+
+        self._matrix = None
+        self._file.close()
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _resize(self, capacity):
+        if self._matrix is not None:
+            self._matrix.flush()
+        self._file.truncate(capacity * len(FEATURES) * 4)
+        self._matrix = np.memmap(self._file.name, dtype=np.float32, mode="r+", shape=(capacity, len(FEATURES)))
+        self.capacity = capacity
+
+def cluster_buffer(buffer, strategy=None, k_max=20, chunk_size=CHUNK_SIZE, sample_size=STREAMING_SAMPLE_SIZE, epochs=STREAMING_EPOCHS, random_state=RANDOM_STATE):
+    """Clusters the tracks in a feature buffer by audio features, a chunk at a time.
+
+    Out-of-core counterpart of cluster_tracks. The scaler and an incremental PCA are fitted over the buffer
+    chunk by chunk, keeping enough components to explain 80% of the variance. The number of clusters is chosen
+    with model_selection.select_k on a random sample of the tracks, then MiniBatchKMeans, started from the
+    sample's clusters, is refined over the whole buffer and assigns every track its cluster, again a chunk at a
+    time. Memory use depends on the chunk and sample sizes, not on the number of tracks.
+
+    Args:
+        buffer (FeatureBuffer): Audio features of the tracks to cluster
+        strategy (str): Strategy for choosing the number of clusters, see model_selection.select_k
+        k_max (int): Largest number of clusters to try
+        chunk_size (int): Number of tracks processed at once
+        sample_size (int): Number of tracks to choose the number of clusters on
+        epochs (int): Number of passes over the buffer to refine the clusters
+        random_state (int): Seed for sampling and K-means
+
+    Returns:
+        tuple: The number of clusters and an int32 array with the cluster label of each track, in buffer order
+    """
+
+    n = len(buffer)
+
+    with stage("scaling"):
+        scaler = preprocessing.MinMaxScaler()
+        for chunk in buffer.chunks(chunk_size):
+            scaler.partial_fit(chunk)
+
+    # Arbitrarily chose 0.8 as cutoff for explained variance
+    with stage("pca"):
+        pca = decomposition.IncrementalPCA(n_components=len(FEATURES))
+        for chunk in buffer.chunks(chunk_size):
+            # IncrementalPCA needs at least as many tracks per chunk as components
+            if len(chunk) >= len(FEATURES) or not hasattr(pca, "components_"):
+                pca.partial_fit(scaler.transform(chunk))
+        n_components = int(np.searchsorted(np.cumsum(pca.explained_variance_ratio_), 0.8) + 1)
+        n_components = min(n_components, len(FEATURES))
+
+    def reduce(chunk):
+        return ((scaler.transform(chunk) - pca.mean_) @ pca.components_[:n_components].T).astype(np.float32)
+
+    # Choose the number of clusters, and the starting centers, on a sample
+    rng = np.random.RandomState(random_state)
+    sample_indices = np.sort(rng.choice(n, size=min(n, sample_size), replace=False))
+    sample = reduce(buffer.take(sample_indices))
+    selection = select_k(sample, strategy=strategy, k_max=k_max)
+    k = selection.k
+    centers = np.vstack([sample[selection.labels == i].mean(axis=0) for i in range(k)])
+
+    with stage("kmeans"):
+        model = cluster.MiniBatchKMeans(n_clusters=k, init=centers, n_init=1, batch_size=1024, random_state=random_state)
+        for _ in range(epochs):
+            for chunk in buffer.chunks(chunk_size):
+                model.partial_fit(reduce(chunk))
+
+        labels = np.empty(n, dtype=np.int32)
+        offset = 0
+        for chunk in buffer.chunks(chunk_size):
+            labels[offset:offset+len(chunk)] = model.predict(reduce(chunk))
+            offset += len(chunk)
+
+    logger.info("Clustered %d tracks out of core into %d clusters using %d components", n, k, n_components)
+    return k, labels
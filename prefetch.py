@@ -0,0 +1,185 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, CancelledError, TimeoutError
+import generate_playlists as gp
+from instrumentation import metrics
+from jobs import report_progress
+
+logger = logging.getLogger(__name__)
+
+# Prefetches running at once (0 disables prefetching), prefetches queued or running at once, and seconds a job
+# waits for its user's prefetch to finish, overridable through the environment
+MAX_WORKERS = int(os.getenv("LAZIFY_PREFETCH_WORKERS", 2))
+MAX_PENDING = int(os.getenv("LAZIFY_PREFETCH_QUEUE_SIZE", 16))
+WAIT = float(os.getenv("LAZIFY_PREFETCH_WAIT", 30))
+# Number of tracks to request audio features for between cancellation checks
+CHUNK_SIZE = 1000
+
+class PrefetchTask:
+    """A prefetch of one user's selected playlists.
+
+    Args:
+        selected_playlists (tuple): Ids for the selected playlists
+    """
+
+    def __init__(self, selected_playlists):
+        self.selected_playlists = selected_playlists
+        self.cancelled = threading.Event()
+        self.future = None
+
+class Prefetcher:
+    """Warms the track caches for selected playlists while the user picks an option.
+
+    Downloads the tracks and audio features of a user's selection in the background, through the shared caches
+    and the track store, so the job that follows finds them there. Each user has at most one prefetch: selecting
+    the same playlists again reuses the running one, and selecting different playlists cancels it. Prefetches
+    run on a small thread pool and are dropped once too many are waiting, since they are only an optimization.
+
+    Args:
+        max_workers (int): Maximum number of prefetches running at once, 0 to disable prefetching
+        max_pending (int): Maximum number of prefetches queued or running at once
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, max_pending=MAX_PENDING):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch") if max_workers > 0 else None
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def start(self, user_id, spotify, selected_playlists, snapshot_ids=None):
+        """Starts prefetching a user's selected playlists, unless they are already being prefetched.
+
+        Args:
+            user_id (str): Spotify user id
+            spotify (spotipy.Spotify): Spotify API object for the user
+            selected_playlists (list): List of ids for the selected playlists
+            snapshot_ids (list): List of snapshot ids for the selected playlists, if already known
+
+        Returns:
+            PrefetchTask: The user's prefetch, or None if prefetching is disabled or too many are pending
+        """
+
+        if self._executor is None:
+            return None
+
+        selected_playlists = tuple(selected_playlists)
+        with self._lock:
+            task = self._tasks.get(user_id)
+            if task is not None:
+                if task.selected_playlists == selected_playlists:
+                    metrics.inc("lazify_prefetches_total", {"result": "deduplicated"})
+                    return task
+                self._cancel(user_id)
+
+            if len(self._tasks) >= self.max_pending:
+                metrics.inc("lazify_prefetches_total", {"result": "dropped"})
+                return None
+
+            task = PrefetchTask(selected_playlists)
+            self._tasks[user_id] = task
+            task.future = self._executor.submit(self._run, task, user_id, spotify, snapshot_ids)
+
+        return task
+
+    def cancel(self, user_id):
+        """Cancels a user's prefetch, if there is one.
+
+        Args:
+            user_id (str): Spotify user id
+
+        Returns:
+            None
+        """
+
+        with self._lock:
+            self._cancel(user_id)
+
+    def wait(self, user_id, timeout=WAIT):
+        """Waits for a user's prefetch to finish.
+
+        Args:
+            user_id (str): Spotify user id
+            timeout (float): Maximum number of seconds to wait
+
+        Returns:
+            bool: Whether the user has no prefetch running anymore
+        """
+
+        with self._lock:
+            task = self._tasks.get(user_id)
+        if task is None:
+            return True
+
+        try:
+            task.future.result(timeout)
+        except CancelledError:
+            pass
+        except TimeoutError:
+            return False
+
+        return True
+
+    def after(self, user_id, function, *args, **kwargs):
+        """Runs a function once the user's prefetch has finished.
+
+        Used to wrap generation jobs, so a job queued while its tracks are still being prefetched doesn't
+        download them a second time.
+
+        Args:
+            user_id (str): Spotify user id
+            function (callable): Function to run
+            *args: Positional arguments for the function
+            **kwargs: Keyword arguments for the function
+
+        Returns:
+            object: The function's return value
+        """
+
+        with self._lock:
+            pending = user_id in self._tasks
+        if pending:
+            report_progress("Getting your tracks")
+            self.wait(user_id)
+
+        return function(*args, **kwargs)
+
+    def _cancel(self, user_id):
+        task = self._tasks.pop(user_id, None)
+        if task is not None:
+            task.cancelled.set()
+            task.future.cancel()
+            metrics.inc("lazify_prefetches_total", {"result": "cancelled"})
+
+    def _run(self, task, user_id, spotify, snapshot_ids):
+        start = time.perf_counter()
+        result = "failed"
+        try:
+            snapshot_ids = snapshot_ids or [None] * len(task.selected_playlists)
+            uris = {}
+            for playlist, snapshot_id in zip(task.selected_playlists, snapshot_ids):
+                if task.cancelled.is_set():
+                    return
+                for track in gp.get_playlist_tracks(spotify, user_id, playlist, snapshot_id):
+                    uris[track[0]] = None
+
+            uris = list(uris)
+            for offset in range(0, len(uris), CHUNK_SIZE):
+                if task.cancelled.is_set():
+                    return
+                gp.get_audio_features(spotify, uris[offset:offset+CHUNK_SIZE])
+
+            result = "completed"
+            logger.info("Prefetched %d tracks for %s in %.2f s", len(uris), user_id, time.perf_counter() - start)
+        except Exception:
+            logger.warning("Prefetch for %s failed", user_id, exc_info=True)
+        finally:
+            with self._lock:
+                if self._tasks.get(user_id) is task:
+                    del self._tasks[user_id]
+            if not task.cancelled.is_set():
+                metrics.inc("lazify_prefetches_total", {"result": result})
+            metrics.observe("lazify_prefetch_seconds", value=time.perf_counter() - start)
+
+prefetcher = Prefetcher()
@@ -0,0 +1,95 @@
+import os
+from lazy import lazy_import
+
+np = lazy_import("numpy")
+neighbors = lazy_import("sklearn.neighbors")
+
+# Approximate number of similarity scores held in memory at once
+MAX_BLOCK_ELEMENTS = 4 * 1024 * 1024
+# Candidate pool size above which the nearest-neighbour index is used by default
+INDEX_THRESHOLD = int(os.getenv("LAZIFY_RANKING_INDEX_THRESHOLD", 50000))
+
+def rank_candidates(seeds, candidates, k=25, aggregate="max", method=None, dtype="float32"):
+    """Ranks candidate tracks by cosine similarity to a set of seed tracks.
+
+    Scores every candidate against every seed and aggregates each candidate's scores across the seeds, then
+    picks the k best candidates with argpartition. Each candidate is picked at most once. The scores are
+    computed in blocks of seeds so memory stays bounded no matter how many seeds there are.
+
+    Args:
+        seeds (numpy.ndarray): Features of the seed tracks, of shape (number of seeds, number of features)
+        candidates (numpy.ndarray): Features of the candidate tracks, of shape (number of candidates, number
+            of features)
+        k (int): Number of candidates to pick
+        aggregate (str): How to combine a candidate's scores across seeds, "max" or "mean"
+        method (str): "exact" to score every pair, or "index" to only score each seed's nearest candidates
+            using a nearest-neighbour index. Defaults to "index" for very large candidate pools.
+        dtype (str or numpy.dtype): Floating point type to compute the scores in
+
+    Returns:
+        numpy.ndarray: Indices of the picked candidates, best first
+    """
+
+    if aggregate not in ("max", "mean"):
+        raise ValueError(f"Unknown aggregate: {aggregate}")
+
+    seeds = _normalize(np.asarray(seeds, dtype=dtype))
+    candidates = _normalize(np.asarray(candidates, dtype=dtype))
+    if method is None:
+        method = "index" if len(candidates) > INDEX_THRESHOLD else "exact"
+
+    if method == "exact":
+        scores = _exact_scores(seeds, candidates, aggregate)
+    elif method == "index":
+        scores = _index_scores(seeds, candidates, k, aggregate)
+    else:
+        raise ValueError(f"Unknown ranking method: {method}")
+
+    k = min(k, len(candidates))
+    if k == 0:
+        return np.empty(0, dtype=int)
+
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+def _normalize(X):
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return X / norms
+
+def _exact_scores(seeds, candidates, aggregate):
+    block_size = max(1, MAX_BLOCK_ELEMENTS // max(len(candidates), 1))
+    if aggregate == "max":
+        scores = np.full(len(candidates), -np.inf, dtype=candidates.dtype)
+    else:
+        scores = np.zeros(len(candidates), dtype=candidates.dtype)
+
+    for start in range(0, len(seeds), block_size):
+        block = seeds[start:start+block_size] @ candidates.T
+        if aggregate == "max":
+            np.maximum(scores, block.max(axis=0), out=scores)
+        else:
+            scores += block.sum(axis=0)
+
+    if aggregate == "mean":
+        scores /= max(len(seeds), 1)
+
+    return scores
+
+def _index_scores(seeds, candidates, k, aggregate):
+    # On unit vectors, cosine similarity is 1 - (euclidean distance)^2 / 2
+    n_neighbors = min(k, len(candidates))
+    index = neighbors.NearestNeighbors(n_neighbors=n_neighbors, algorithm="kd_tree").fit(candidates)
+    distances, nearest = index.kneighbors(seeds)
+    similarities = 1 - distances.ravel() ** 2 / 2
+
+    if aggregate == "max":
+        scores = np.full(len(candidates), -np.inf, dtype=candidates.dtype)
+        np.maximum.at(scores, nearest.ravel(), similarities)
+    else:
+        # Candidates that aren't among a seed's neighbours contribute nothing to the mean
+        scores = np.zeros(len(candidates), dtype=candidates.dtype)
+        np.add.at(scores, nearest.ravel(), similarities)
+        scores /= max(len(seeds), 1)
+
+    return scores
@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from spotipy.exceptions import SpotifyException
+from fetch import retry_after
+from instrumentation import metrics
+
+# Sustained and burst request rates, overridable through the environment
+RATE = float(os.getenv("LAZIFY_RATE_LIMIT", 50))
+BURST = float(os.getenv("LAZIFY_RATE_LIMIT_BURST", 50))
+MIN_RATE = 1.0
+# Requests per second regained for every second without throttling, and the factor applied on a 429
+RATE_INCREASE = 1.0
+RATE_DECREASE = 0.5
+# Share of the burst that only interactive calls may use
+RESERVE = 0.2
+# Longest a waiting call sleeps before checking the bucket again
+MAX_SLEEP = 1.0
+
+INTERACTIVE, BULK = "interactive", "bulk"
+
+class MemoryBackend:
+    """Keeps the rate limiter's state in memory, shared by the threads of one process."""
+
+    def __init__(self):
+        self._state = None
+        self._lock = threading.Lock()
+
+    def update(self, function):
+        with self._lock:
+            self._state, result = function(self._state)
+            return result
+
+class SQLiteBackend:
+    """Keeps the rate limiter's state in a SQLite database.
+
+    Every update runs in its own write transaction, so all the processes using the same database file share
+    one bucket.
+
+    Args:
+        path (str): Path to the SQLite database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute("CREATE TABLE IF NOT EXISTS rate_limit (id INTEGER PRIMARY KEY, data TEXT)")
+
+    def update(self, function):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT data FROM rate_limit WHERE id = 0").fetchone()
+            state, result = function(json.loads(row[0]) if row is not None else None)
+            conn.execute("INSERT OR REPLACE INTO rate_limit VALUES (0, ?)", (json.dumps(state),))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        return result
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+
+        return conn
+
+class RateLimiter:
+    """Token bucket limiting the rate of Spotify API calls.
+
+    Calls take a token from the bucket, which refills at the current rate up to the burst size. When the API
+    responds with 429, every caller pauses for the Retry-After period and the rate is halved, then it grows
+    back slowly while calls go through, so the rate settles just under what the API allows. Bulk calls leave
+    part of the bucket to interactive calls, so page loads aren't stuck behind background jobs.
+
+    Args:
+        backend (MemoryBackend or SQLiteBackend): Where the bucket's state is kept
+        rate (float): Maximum sustained rate, in calls per second
+        burst (float): Maximum number of calls made at once
+        min_rate (float): Rate never to go below, in calls per second
+        reserve (float): Share of the burst only interactive calls may use
+    """
+
+    def __init__(self, backend, rate=RATE, burst=BURST, min_rate=MIN_RATE, reserve=RESERVE):
+        self.backend = backend
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.reserve = reserve
+
+    def acquire(self, priority=BULK):
+        """Waits until a call may be made.
+
+        Args:
+            priority (str): INTERACTIVE for calls serving a page load, BULK for background work
+
+        Returns:
+            float: Seconds spent waiting
+        """
+
+        start = time.perf_counter()
+        while True:
+            wait = self.backend.update(lambda state: self._take(state, time.time(), priority))
+            if wait <= 0:
+                break
+            time.sleep(min(wait, MAX_SLEEP))
+
+        waited = time.perf_counter() - start
+        metrics.observe("lazify_rate_limit_wait_seconds", {"priority": priority}, waited)
+        return waited
+
+    def throttle(self, seconds):
+        """Pauses every caller and lowers the rate after a 429 response.
+
+        Args:
+            seconds (float): Seconds to pause for, from the Retry-After header
+
+        Returns:
+            None
+        """
+
+        self.backend.update(lambda state: self._throttle(state, time.time(), seconds))
+        metrics.inc("lazify_rate_limited_total")
+
+    def current_rate(self):
+        """Returns the rate calls are currently allowed at.
+
+        Returns:
+            float: Current rate, in calls per second
+        """
+
+        return self.backend.update(lambda state: self._peek(state, time.time()))
+
+    def _refill(self, state, now):
+        if state is None:
+            state = {"tokens": self.burst, "rate": self.rate, "updated_at": now, "paused_until": 0.0}
+
+        elapsed = max(now - state["updated_at"], 0.0)
+        if now >= state["paused_until"]:
+            state["rate"] = min(self.rate, state["rate"] + RATE_INCREASE * elapsed)
+            state["tokens"] = min(self.burst, state["tokens"] + state["rate"] * elapsed)
+        state["updated_at"] = now
+        return state
+
+    def _take(self, state, now, priority):
+        state = self._refill(state, now)
+        if now < state["paused_until"]:
+            return state, state["paused_until"] - now
+
+        floor = 0.0 if priority == INTERACTIVE else self.burst * self.reserve
+        if state["tokens"] >= floor + 1:
+            state["tokens"] -= 1
+            return state, 0.0
+
+        return state, (floor + 1 - state["tokens"]) / state["rate"]
+
+    def _throttle(self, state, now, seconds):
+        state = self._refill(state, now)
+        state["paused_until"] = max(state["paused_until"], now + seconds)
+        state["rate"] = max(self.min_rate, state["rate"] * RATE_DECREASE)
+        state["tokens"] = 0.0
+        return state, None
+
+    def _peek(self, state, now):
+        state = self._refill(state, now)
+        return state, state["rate"]
+
+def limit(spotify, limiter=None, priority=BULK):
+    """Makes a Spotify API client wait for the rate limiter before every call.
+
+    429 responses with a Retry-After header throttle the limiter, so every client sharing it backs off together
+    instead of each retrying on its own. Other errors reported as 429 don't, since they aren't the API asking
+    to slow down.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object
+        limiter (RateLimiter): Rate limiter to use, the process-wide one by default
+        priority (str): INTERACTIVE for clients serving page loads, BULK for background work
+
+    Returns:
+        spotipy.Spotify: The same Spotify API object
+    """
+
+    limiter = limiter or rate_limiter
+    internal_call = getattr(spotify, "_internal_call", None)
+    if internal_call is None or getattr(spotify, "_lazify_limited", False):
+        return spotify
+
+    def limited_call(method, url, payload, params):
+        limiter.acquire(priority)
+        try:
+            return internal_call(method, url, payload, params)
+        except SpotifyException as e:
+            if e.http_status == 429 and (e.headers or {}).get("Retry-After") is not None:
+                limiter.throttle(retry_after(e))
+            raise
+
+    spotify._internal_call = limited_call
+    spotify._lazify_limited = True
+
+    return spotify
+
+def create_limiter():
+    """Creates a rate limiter using the backend configured in the environment.
+
+    Uses a SQLiteBackend if LAZIFY_RATE_LIMIT_PATH is set, so every process shares the limit, otherwise a
+    MemoryBackend.
+
+    Returns:
+        RateLimiter: The new rate limiter
+    """
+
+    path = os.getenv("LAZIFY_RATE_LIMIT_PATH")
+    backend = SQLiteBackend(path) if path else MemoryBackend()
+    return RateLimiter(backend)
+
+rate_limiter = create_limiter()
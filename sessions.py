@@ -0,0 +1,107 @@
+import os
+import secrets
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+from cache import LRUCache, SQLiteCache
+
+# Path to the session store's database file, overridable through the environment; "memory" to keep sessions in
+# an in-process LRU cache, which only suits a single worker process, or empty to keep them in signed cookies
+STORE_PATH = os.getenv("LAZIFY_SESSION_STORE", "lazify_sessions.db")
+# Most sessions kept at once, and seconds a session lasts after it last changed, overridable through the environment
+MAX_SESSIONS = int(os.getenv("LAZIFY_SESSION_MAX_SIZE", 10000))
+SESSION_TTL = float(os.getenv("LAZIFY_SESSION_TTL", 7 * 24 * 60 * 60))
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session whose data is kept on the server, identified by a random id in the cookie.
+
+    Args:
+        initial (dict): Session data loaded from the store
+        sid (str): Id for the session, or None for a new session
+    """
+
+    def __init__(self, initial=None, sid=None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self.rotate = False
+
+    def clear(self):
+        # Clearing the session starts a new one, e.g. on login, so an id handed out before can't be reused
+        super().clear()
+        self.rotate = True
+
+class ServerSessionInterface(SessionInterface):
+    """Flask session interface that keeps session data in a server-side store.
+
+    The cookie only carries the session's id, so requests stay small no matter how much is kept in the session,
+    and nothing has to be signed or verified on each request. Ids the store doesn't know are never reused, so a
+    session can't be fixed to an id chosen by someone else.
+
+    Args:
+        store (SQLiteCache or LRUCache): Where sessions are kept, keyed by id
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        data = self.store.get(sid) if sid else None
+        if data is None:
+            return ServerSession()
+
+        return ServerSession(data, sid)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.rotate and session.sid is not None:
+            self.store.delete(session.sid)
+            session.sid = None
+
+        if not session:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not session.modified and session.sid is not None:
+            return
+
+        session.sid = session.sid or secrets.token_urlsafe(32)
+        self.store.set(session.sid, dict(session))
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app)
+        )
+
+def create_session_interface():
+    """Creates a session interface using the store configured in the environment.
+
+    Keeps sessions in an on-disk SQLiteCache at LAZIFY_SESSION_STORE, so every gunicorn worker sees the same
+    sessions and they survive restarts. With LAZIFY_SESSION_STORE=memory, sessions are kept in an in-process
+    LRUCache instead, for a single worker process or local development. Deployments whose processes don't share
+    a disk can set LAZIFY_SESSION_STORE to an empty string to keep sessions in Flask's signed cookies instead.
+
+    Returns:
+        SessionInterface: The new session interface
+    """
+
+    if not STORE_PATH:
+        return SecureCookieSessionInterface()
+    if STORE_PATH == "memory":
+        return ServerSessionInterface(LRUCache(max_size=MAX_SESSIONS, ttl=SESSION_TTL))
+
+    return ServerSessionInterface(SQLiteCache(STORE_PATH, max_size=MAX_SESSIONS, ttl=SESSION_TTL, namespace="sessions"))
@@ -0,0 +1,88 @@
+import os
+import requests
+import spotipy as sp
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from spotipy.oauth2 import SpotifyOAuth
+from urllib3.util.retry import Retry
+from instrumentation import instrument
+from ratelimit import INTERACTIVE, limit
+
+# Connections kept alive per host and request timeout in seconds, overridable through the environment
+POOL_SIZE = int(os.getenv("LAZIFY_HTTP_POOL_SIZE", 32))
+TIMEOUT = float(os.getenv("LAZIFY_HTTP_TIMEOUT", 10))
+
+class SharedSession(requests.Session):
+    """HTTP session shared by every Spotify API client in the process.
+
+    spotipy closes a client's session when the client is garbage collected, which would drop the pooled
+    connections after every request, so closing a shared session does nothing.
+    """
+
+    def close(self):
+        pass
+
+def create_session(pool_size=POOL_SIZE):
+    """Creates a pooled HTTP session for the Spotify API.
+
+    Connections are kept alive and reused across requests, so only the first call to each host pays for the
+    TLS handshake. Only failed connections are retried here. Error responses are returned as they are, so
+    server errors reach fetch.call_with_retry with their real status and are retried in one place, and 429
+    responses reach the rate limiter, so throttling pauses every client instead of sleeping inside each request.
+
+    Args:
+        pool_size (int): Maximum number of connections kept alive per host, which should cover the number
+            of threads making calls at once
+
+    Returns:
+        SharedSession: The new session
+    """
+
+    # Retrying statuses here too would send non-idempotent calls such as adding tracks several times per
+    # attempt, and spotipy reports exhausted status retries as a 429 without headers
+    retry = Retry(
+        total=3,
+        connect=3,
+        read=False,
+        status=0,
+        allowed_methods=frozenset(["GET", "POST", "PUT", "DELETE"]),
+        backoff_factor=0.3
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+
+    session = SharedSession()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+session = create_session()
+
+def create_client(access_token, priority=INTERACTIVE):
+    """Creates an instrumented, rate limited Spotify API object using the shared session.
+
+    Args:
+        access_token (str): The user's access token
+        priority (str): INTERACTIVE for clients serving page loads, BULK for background jobs
+
+    Returns:
+        spotipy.Spotify: Spotify API object
+    """
+
+    spotify = sp.Spotify(auth=access_token, requests_session=session, requests_timeout=TIMEOUT)
+    return limit(instrument(spotify), priority=priority)
+
+@lru_cache(maxsize=None)
+def get_oauth(client_id, client_secret, redirect_uri, scope):
+    """Returns the Spotify OAuth object for a set of parameters, creating it on first use.
+
+    Args:
+        client_id (str): Spotify app's client id
+        client_secret (str): Spotify app's client secret
+        redirect_uri (str): URI Spotify redirects to after login
+        scope (str): Scopes to request
+
+    Returns:
+        spotipy.oauth2.SpotifyOAuth: Spotify OAuth object using the shared session
+    """
+
+    return SpotifyOAuth(client_id, client_secret, redirect_uri, scope=scope, requests_session=session, requests_timeout=TIMEOUT)
@@ -64,4 +64,65 @@ function validateSelectArtists() {
         alert("Please select at least one (1) artist");
         return false;
     }
+}
+
+function pollJob(jobElement) {
+    let jobId = jobElement.getAttribute("data-job-id");
+
+    $.getJSON("/jobs/" + jobId, function(job) {
+        if (job.status === "done" || job.status === "failed") {
+            window.location.reload();
+        } else {
+            jobElement.textContent = job.progress;
+            setTimeout(function() { pollJob(jobElement); }, 2000);
+        }
+    });
+}
+
+function addEmbed(source) {
+    let item = document.createElement("a");
+    item.className = "list-group-item list-group-item-action d-flex justify-content-between align-items-center";
+
+    let embed = document.createElement("iframe");
+    embed.style.borderRadius = "12px";
+    embed.src = source;
+    embed.width = "100%";
+    embed.height = "380";
+    embed.frameBorder = "0";
+    embed.allowFullscreen = true;
+    embed.allow = "autoplay; clipboard-write; encrypted-media; fullscreen; picture-in-picture";
+
+    item.appendChild(embed);
+    document.getElementById("playlist-embeds").appendChild(item);
+}
+
+function streamJob(jobElement) {
+    let jobId = jobElement.getAttribute("data-job-id");
+    let shown = jobElement.getAttribute("data-shown");
+    let events = new EventSource("/jobs/" + jobId + "/events?after=" + shown);
+
+    events.addEventListener("progress", function(event) {
+        jobElement.textContent = event.data;
+    });
+    events.addEventListener("playlist", function(event) {
+        addEmbed(event.data);
+    });
+    events.addEventListener("done", function() {
+        events.close();
+        document.getElementById("job-status").hidden = true;
+        document.getElementById("job-done").hidden = false;
+    });
+    events.addEventListener("failed", function() {
+        events.close();
+        window.location.reload();
+    });
+}
+
+let jobElement = document.getElementById("job-progress");
+if (jobElement) {
+    if (window.EventSource) {
+        streamJob(jobElement);
+    } else {
+        pollJob(jobElement);
+    }
 }
\ No newline at end of file
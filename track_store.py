@@ -0,0 +1,149 @@
+import os
+import time
+import sqlite3
+import threading
+from track_table import FEATURES
+
+# Path to the track store's database file, overridable through the environment; empty to disable the store
+STORE_PATH = os.getenv("LAZIFY_TRACK_STORE", "lazify_tracks.db")
+
+class TrackStore:
+    """Persistent store of playlist contents and audio features.
+
+    Keeps the tracks of each playlist for the snapshot they were downloaded at, and the audio features of every
+    track seen so far, in a SQLite database. Playlists are only downloaded again when their snapshot id changes
+    and audio features, which never change, are only requested once per track. Tracks the API has no audio
+    features for are remembered too, so they aren't requested again either.
+
+    Args:
+        path (str): Path to the SQLite database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        feature_columns = ", ".join(f"{feature} REAL" for feature in FEATURES)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS playlists (id TEXT PRIMARY KEY, snapshot_id TEXT, synced_at REAL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS playlist_tracks (playlist_id TEXT, position INTEGER, uri TEXT, name TEXT, "
+                "artist_id TEXT, artist_name TEXT, PRIMARY KEY (playlist_id, position)) WITHOUT ROWID"
+            )
+            conn.execute(f"CREATE TABLE IF NOT EXISTS features (uri TEXT PRIMARY KEY, available INTEGER, {feature_columns})")
+
+    def get_tracks(self, playlist_id, snapshot_id):
+        """Retrieves the stored tracks of a playlist, if they are for the given snapshot.
+
+        Args:
+            playlist_id (str): Id for the playlist
+            snapshot_id (str): The playlist's current snapshot id
+
+        Returns:
+            list: List of (uri, name, artist id, artist name) tuples in playlist order, or None if the playlist
+                isn't stored or has changed since
+        """
+
+        conn = self._connect()
+
+        # Read the snapshot id and the tracks in one transaction, so they can't be from different syncs
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute("SELECT snapshot_id FROM playlists WHERE id = ?", (playlist_id,)).fetchone()
+            if row is None or row[0] != snapshot_id:
+                return None
+
+            return conn.execute(
+                "SELECT uri, name, artist_id, artist_name FROM playlist_tracks WHERE playlist_id = ? ORDER BY position",
+                (playlist_id,)
+            ).fetchall()
+        finally:
+            conn.rollback()
+
+    def set_tracks(self, playlist_id, snapshot_id, tracks):
+        """Stores the tracks of a playlist, replacing those stored for an earlier snapshot.
+
+        Args:
+            playlist_id (str): Id for the playlist
+            snapshot_id (str): Snapshot id the tracks were downloaded at
+            tracks (list): List of (uri, name, artist id, artist name) tuples in playlist order
+
+        Returns:
+            None
+        """
+
+        with self._connect() as conn:
+            conn.execute("DELETE FROM playlist_tracks WHERE playlist_id = ?", (playlist_id,))
+            conn.executemany(
+                "INSERT INTO playlist_tracks VALUES (?, ?, ?, ?, ?, ?)",
+                [(playlist_id, position, *track) for position, track in enumerate(tracks)]
+            )
+            conn.execute("INSERT OR REPLACE INTO playlists VALUES (?, ?, ?)", (playlist_id, snapshot_id, time.time()))
+
+    def get_features(self, uris):
+        """Retrieves the stored audio features of tracks.
+
+        Args:
+            uris (iterable): Track uris to look up
+
+        Returns:
+            dict: Mapping of the uris that have been seen before to their audio feature dicts, or to None if the
+                API has no audio features for them
+        """
+
+        uris = list(uris)
+        found = {}
+        conn = self._connect()
+
+        # SQLite limits the number of bound parameters per statement
+        for offset in range(0, len(uris), 500):
+            chunk = uris[offset:offset+500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT uri, available, {', '.join(FEATURES)} FROM features WHERE uri IN ({placeholders})", chunk
+            ).fetchall()
+            for uri, available, *values in rows:
+                found[uri] = dict(zip(FEATURES, values)) if available else None
+
+        return found
+
+    def set_features(self, mapping):
+        """Stores the audio features of tracks.
+
+        Args:
+            mapping (dict): Mapping of track uris to audio feature dicts, or to None if the API has no audio
+                features for them
+
+        Returns:
+            None
+        """
+
+        rows = [
+            (uri, 0, *([None] * len(FEATURES))) if features is None
+            else (uri, 1, *(features[feature] for feature in FEATURES))
+            for uri, features in mapping.items()
+        ]
+        placeholders = ",".join("?" * (len(FEATURES) + 2))
+        with self._connect() as conn:
+            conn.executemany(f"INSERT OR REPLACE INTO features VALUES ({placeholders})", rows)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+
+        return conn
+
+def create_store():
+    """Creates the track store configured in the environment.
+
+    Returns:
+        TrackStore: Store at LAZIFY_TRACK_STORE, or None if it is set to an empty string
+    """
+
+    return TrackStore(STORE_PATH) if STORE_PATH else None
+
+track_store = create_store()
@@ -0,0 +1,71 @@
+from lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+# Audio features used to describe tracks
+FEATURES = ["acousticness", "danceability", "energy", "instrumentalness", "liveness", "loudness", "speechiness", "valence"]
+
+def build_track_table(track_lists, features=None):
+    """Builds a single table of unique tracks from one or more track lists.
+
+    Deduplicates the tracks on uri with a hash index, keeping the first occurrence, and writes them straight
+    into preallocated arrays, so the table is assembled once no matter how many playlists are combined. The
+    uri and artist columns are categorical and the audio features are stored as float32.
+
+    Args:
+        track_lists (list): List of track lists, each a list of (uri, name, artist id, artist name) tuples
+        features (dict): Mapping of track uris to audio feature dicts, or None to build the table without
+            audio features. Tracks without audio features are left out.
+
+    Returns:
+        pandas.DataFrame: DataFrame with name, artist, artist_id and uri columns, plus a column per audio
+            feature if features were given
+    """
+
+    # Hash index of the first occurrence of each uri
+    unique = {}
+    for tracks in track_lists:
+        for track in tracks:
+            if track[0] not in unique and (features is None or features.get(track[0]) is not None):
+                unique[track[0]] = track
+
+    n = len(unique)
+    uris = np.empty(n, dtype=object)
+    names = np.empty(n, dtype=object)
+    artist_ids = np.empty(n, dtype=object)
+    artists = np.empty(n, dtype=object)
+    for i, (uri, name, artist_id, artist) in enumerate(unique.values()):
+        uris[i] = uri
+        names[i] = name
+        artist_ids[i] = artist_id
+        artists[i] = artist
+
+    columns = {
+        "name": names,
+        "artist": pd.Categorical(artists),
+        "artist_id": pd.Categorical(artist_ids),
+        "uri": pd.Categorical(uris)
+    }
+
+    if features is not None:
+        matrix = np.empty((n, len(FEATURES)), dtype=np.float32, order="F")
+        for i, uri in enumerate(uris):
+            track_features = features[uri]
+            matrix[i] = [track_features[feature] for feature in FEATURES]
+        for j, feature in enumerate(FEATURES):
+            columns[feature] = matrix[:, j]
+
+    return pd.DataFrame(columns)
+
+def feature_matrix(data):
+    """Returns the audio features of a track table as a float32 matrix.
+
+    Args:
+        data (pandas.DataFrame): Track table from build_track_table
+
+    Returns:
+        numpy.ndarray: Array of shape (number of tracks, number of audio features)
+    """
+
+    return data[FEATURES].to_numpy(dtype=np.float32)
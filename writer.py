@@ -0,0 +1,265 @@
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from spotipy.exceptions import SpotifyException
+from catalog import invalidate
+from fetch import call_with_retry, retry_delay
+from instrumentation import count_retry, in_current_context, stage
+
+logger = logging.getLogger(__name__)
+
+# Number of playlists written at once, overridable through the environment
+MAX_WORKERS = int(os.getenv("LAZIFY_WRITE_WORKERS", 20))
+BATCH_SIZE = 100
+# Batches a PlaylistStream holds before add() waits for the writes to catch up
+MAX_PENDING = 8
+
+class PlaylistWriteError(Exception):
+    """Raised when tracks couldn't be added to one or more playlists.
+
+    Args:
+        reports (list): Write reports of the playlists that failed, see write_playlists
+    """
+
+    def __init__(self, reports):
+        self.reports = reports
+        super().__init__(
+            f"Couldn't add every track to {len(reports)} playlist{'s' if len(reports) > 1 else ''}: {reports[0]['error']}"
+        )
+
+def write_playlists(spotify, user_id, playlists, max_workers=MAX_WORKERS):
+    """Creates playlists and adds tracks to them.
+
+    Creates every new playlist up front, in order, then adds the tracks to all of the playlists concurrently.
+    Each playlist's tracks are added in batches of 100, one batch after another, so the tracks keep their
+    order. Batches that fail with 429 or a server error are retried with backoff. A playlist whose batch fails
+    otherwise is left as it is while the others are finished, then PlaylistWriteError is raised.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object
+        user_id (str): Spotify user id
+        playlists (list): List of dicts with the uris to write and either the name for a new playlist or the
+            id of an existing playlist to add to
+        max_workers (int): Maximum number of playlists to write at once
+
+    Returns:
+        list: List of write reports, one dict per playlist with its id, name, number of tracks and batches
+            written, number of retries, time spent in seconds and error message if the write failed
+
+    Raises:
+        PlaylistWriteError: If tracks couldn't be added to some of the playlists
+    """
+
+    with stage("playlist_writes"):
+        reports = _create_playlists(spotify, user_id, playlists)
+        list(_write_playlists(spotify, user_id, reports, playlists, max_workers))
+
+    return reports
+
+def iter_write_playlists(spotify, user_id, playlists, max_workers=MAX_WORKERS):
+    """Creates playlists and adds tracks to them, yielding each playlist as soon as it is written.
+
+    Works like write_playlists, except that each playlist's report is yielded as soon as all of its tracks have
+    been added, so callers can show the first playlists while the rest are still being written. The reports
+    come in the order the playlists finish, not the order they were given in. Playlists that failed aren't
+    yielded, and PlaylistWriteError is raised once the others are written.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object
+        user_id (str): Spotify user id
+        playlists (list): List of dicts with the uris to write and either the name for a new playlist or the
+            id of an existing playlist to add to
+        max_workers (int): Maximum number of playlists to write at once
+
+    Yields:
+        dict: Write report for a playlist, see write_playlists
+
+    Raises:
+        PlaylistWriteError: If tracks couldn't be added to some of the playlists
+    """
+
+    with stage("playlist_writes"):
+        reports = _create_playlists(spotify, user_id, playlists)
+        yield from _write_playlists(spotify, user_id, reports, playlists, max_workers)
+
+def _create_playlists(spotify, user_id, playlists):
+    reports = []
+    for playlist in playlists:
+        playlist_id = playlist.get("id")
+        if playlist_id is None:
+            playlist_id = call_with_retry(spotify.user_playlist_create, user_id, playlist["name"], public=False)["id"]
+        reports.append({
+            "id": playlist_id,
+            "name": playlist.get("name"),
+            "tracks": 0,
+            "batches": 0,
+            "retries": 0,
+            "elapsed": 0.0,
+            "error": None
+        })
+
+    return reports
+
+def _write_playlists(spotify, user_id, reports, playlists, max_workers):
+    try:
+        # Playlists without tracks to add are done as soon as they exist
+        jobs = []
+        for report, playlist in zip(reports, playlists):
+            if playlist["uris"]:
+                jobs.append((report, playlist["uris"]))
+            else:
+                yield report
+
+        if len(jobs) <= 1 or max_workers <= 1:
+            for report, uris in jobs:
+                _write_tracks(spotify, user_id, report, uris)
+                if report["error"] is None:
+                    yield report
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+                futures = {executor.submit(in_current_context(_write_tracks), spotify, user_id, report, uris): report for report, uris in jobs}
+                for future in as_completed(futures):
+                    future.result()
+                    if futures[future]["error"] is None:
+                        yield futures[future]
+
+        failed = [report for report in reports if report["error"] is not None]
+        for report in failed:
+            logger.warning("Failed to write playlist %s: %s", report["id"], report["error"])
+        if failed:
+            raise PlaylistWriteError(failed)
+    finally:
+        # The user's playlist listing has changed
+        invalidate(user_id)
+
+class PlaylistStream:
+    """Adds tracks to a playlist while they are still being produced.
+
+    Tracks passed to add() are grouped into batches of 100, which a background thread adds to the playlist in
+    order, with the same retries as write_playlists. At most max_pending batches are held at once, so add()
+    waits when the writes fall behind and memory stays bounded however many tracks are streamed. If a write
+    raises anything other than a Spotify API error, e.g. a connection error or timeout, the thread keeps
+    draining the batches and add() and close() raise that error. If a batch fails with a Spotify API error that
+    isn't retried, close() raises PlaylistWriteError.
+
+    Args:
+        spotify (spotipy.Spotify): Spotify API object
+        user_id (str): Spotify user id
+        playlist_id (str): Id for the playlist to add the tracks to
+        max_pending (int): Maximum number of batches waiting to be written
+    """
+
+    def __init__(self, spotify, user_id, playlist_id, max_pending=MAX_PENDING):
+        self.spotify = spotify
+        self.user_id = user_id
+        self.report = {
+            "id": playlist_id,
+            "name": None,
+            "tracks": 0,
+            "batches": 0,
+            "retries": 0,
+            "elapsed": 0.0,
+            "error": None
+        }
+        self._batch = []
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=in_current_context(self._run), name=f"stream-{playlist_id}", daemon=True)
+        self._thread.start()
+
+    def add(self, uri):
+        """Queues a track to be added to the playlist.
+
+        Args:
+            uri (str): Track uri
+
+        Returns:
+            None
+        """
+
+        if self._error is not None:
+            raise self._error
+
+        self._batch.append(uri)
+        if len(self._batch) == BATCH_SIZE:
+            self._queue.put(self._batch)
+            self._batch = []
+
+    def close(self):
+        """Writes the remaining tracks and waits for every batch to be added.
+
+        Returns:
+            dict: Write report for the playlist, see write_playlists
+
+        Raises:
+            PlaylistWriteError: If some of the tracks couldn't be added
+        """
+
+        if self._batch:
+            self._queue.put(self._batch)
+            self._batch = []
+        self._queue.put(None)
+        self._thread.join()
+
+        if self._error is not None:
+            invalidate(self.user_id)
+            raise self._error
+        invalidate(self.user_id)
+        if self.report["error"] is not None:
+            logger.warning("Failed to write playlist %s: %s", self.report["id"], self.report["error"])
+            raise PlaylistWriteError([self.report])
+
+        return self.report
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        start = time.perf_counter()
+        with stage("playlist_writes"):
+            while True:
+                batch = self._queue.get()
+                if batch is None:
+                    break
+                # Keep draining after a failed write so add() and close() never block
+                if self.report["error"] is not None:
+                    continue
+                try:
+                    _write_tracks(self.spotify, self.user_id, self.report, batch)
+                except Exception as e:
+                    self.report["error"] = str(e)
+                    self._error = e
+
+        self.report["elapsed"] = time.perf_counter() - start
+
+def _write_tracks(spotify, user_id, report, uris):
+    start = time.perf_counter()
+    offset = 0
+    attempt = 0
+    while offset < len(uris):
+        batch = uris[offset:offset+BATCH_SIZE]
+        try:
+            spotify.user_playlist_add_tracks(user_id, report["id"], batch)
+        except SpotifyException as e:
+            delay = retry_delay(e, attempt)
+            if delay is None:
+                report["error"] = str(e)
+                break
+            report["retries"] += 1
+            count_retry(e.http_status)
+            attempt += 1
+            time.sleep(delay)
+            continue
+
+        report["tracks"] += len(batch)
+        report["batches"] += 1
+        offset += BATCH_SIZE
+        attempt = 0
+
+    report["elapsed"] = time.perf_counter() - start